@@ -0,0 +1,295 @@
+"""
+Offline benchmarks for fly niki scraper.
+Synthetic result pages are built by make_search_data, saved responses can be passed as arguments:
+python benchmark.py [saved_response.json|saved_main_template.html ...]
+Whole flyniki_search pipeline and search server (main.serve) are run on replayed responses (see main.TRANSPORT),
+flyniki.com is not used.
+"""
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import datetime
+import tempfile
+import threading
+import collections
+import requests
+import lxml.html
+import main
+
+
+SIZES = {'small': 10, 'medium': 100, 'huge': 1000}
+LOAD = {'clients': 8, 'requests': 200, 'rows': 100}
+FARES = ('Economy Saver', 'Economy Classic', 'Economy Flex', 'Business')
+
+
+def make_search_data(rows, fares=FARES, tables=2, seed=1):
+    """
+    Function return synthetic search data (as json of the result POST) with rows flights in each of tables
+    """
+    rnd = random.Random(seed)
+    html = ['<div><div class="vacancy_route">Moscow (DME) ? London (LON), 1 Adult</div>']
+    for _ in xrange(tables):
+        html.append('<table class="faretypes"><tr><td></td>' +
+                    ''.join('<td><div><label><p>%s</p></label></div></td>' % fare for fare in fares) + '</tr></table>')
+        html.append('<table class="flighttable">')
+        for index in xrange(rows):
+            hour = rnd.randint(0, 23)
+            cells = ''
+            for _ in fares:
+                if rnd.random() < 0.15:
+                    cells += '<td><span>notbookable</span></td>'
+                else:
+                    cells += ('<td><label><div><span>{:,.2f}</span></div><div><span>{:,.2f}</span></div></label></td>'
+                              .format(rnd.randint(50, 3000), rnd.randint(50, 3000)))
+            html.append('<tr class="flightrow{0}"><td></td><td><span><time>{1:02d}:{2:02d}</time>'
+                        '<time>{3:02d}:{2:02d}</time>{4}</span></td><td>AB {5}</td><td><span> 3h 05min </span></td>'
+                        '{6}</tr>'.format(' selected' if index == 0 else '', hour, rnd.randint(0, 59), (hour + 3) % 24,
+                                          '<strong>+1</strong>' if hour > 20 else '', 1000 + index, cells))
+        html.append('</table>')
+    html.append('</div>')
+    return {'templates': {'main': ''.join(html),
+                          'priceoverview': '<table><tr class="additionals-tsc"><td>Taxes and fees</td>'
+                                           '<td> RUB 1,234.50</td></tr></table>',
+                          'infos': '',
+                          'flightinfo': '',
+                          'dateoverview': '<div class="dateoverview"></div>'}}
+
+
+def legacy_data_processing(search_html, return_date):
+    """
+    Per-cell XPath parser, as data_processing was before the single-pass parser. Kept for comparison
+    """
+    fare_types = []
+    flights = []
+    flight_tables = 1 if return_date == 'oneway' else 2
+    for table in xrange(1, flight_tables+1):
+        flights.append([])
+        fare_types.append(search_html.xpath('(//*[@class="faretypes"])[{}]//td/div[1]/label/p/text()'.format(table)))
+        fly_rows = search_html.xpath('(//*[@class="flighttable"])[{0}]//*[@class="flightrow"]'
+                                     '|(//*[@class="flighttable"])[{0}]//*[@class="flightrow selected"]'.format(table))
+        for index, row in enumerate(fly_rows):
+            flights[table-1].append([])
+            flights[table-1][index].append(str(row.xpath('string(td[2]/span/time[1])')))
+            flights[table-1][index].append(str(row.xpath('string(td[2]/span/time[2])')))
+            flights[table-1][index].append(str(row.xpath('string(td[2]/span/strong)')))
+            flights[table-1][index].append(str(row.xpath('string(td[4]/span)')))
+            for td in xrange(5, 5+len(fare_types[table-1])):
+                if len(row.xpath('string(td[{}]/span)'.format(td))) == 0:
+                    price = row.xpath('string(td[{}]/label/div[2]/span)'.format(td))
+                    low_price = row.xpath('string(td[{}]/label/div[1]/span)'.format(td))
+                    if len(price) == 0:
+                        price = low_price
+                    flights[table-1][index].append(str(price))
+                else:
+                    flights[table-1][index].append('0')
+    return fare_types, flights
+
+
+def measure(function, repeat=3):
+    """
+    Function return best time of repeat calls of function (seconds)
+    """
+    best = None
+    for _ in xrange(repeat):
+        start = time.time()
+        function()
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def load_saved_response(path):
+    """
+    Function return search data from saved response: json of the result POST or html of the main template
+    """
+    with open(path) as saved:
+        text = saved.read()
+    if text.lstrip().startswith('{'):
+        return json.loads(text)
+    return {'templates': {'main': text}}
+
+
+def bench_parser(name, search_data):
+    """
+    Print rows/sec of legacy_data_processing and data_processing on the search data
+    """
+    search_html = lxml.html.fromstring(search_data['templates']['main'])
+    tables = len(main.FLIGHT_TABLES_XPATH(search_html))
+    return_date = 'oneway' if tables < 2 else 'return'
+    rows = sum(len(table) for table in main.data_processing(search_html, return_date)[1])
+    before = measure(lambda: legacy_data_processing(search_html, return_date))
+    after = measure(lambda: main.data_processing(search_html, return_date))
+    print('{0: <25}{1: >8}{2: >16,.0f}{3: >16,.0f}{4: >10.1f}x'.format(
+        name, rows, rows / before, rows / after, before / after))
+
+
+def write_fixtures(path, rows, outbound_date, return_date, dep_iata='DME', dest_iata='LON'):
+    """
+    Write replay fixtures for search dep_iata dest_iata outbound_date return_date with synthetic page of rows flights
+    """
+    main.TRANSPORT['path'] = path
+    suggest_url = 'http://www.flyniki.com/en/site/json/suggestAirport.php'
+    vacancy_url = 'http://www.flyniki.com/en/booking/flight/vacancy.php'
+    json_header = {'content-type': 'application/json'}
+    airports = json.dumps({'suggestList': [{'code': dep_iata, 'name': 'Moscow'},
+                                           {'code': dest_iata, 'name': 'London'}]})
+    for departures, searchfor in (('', 'departures'), ('', 'destinations'), (dep_iata, 'destinations')):
+        main.save_fixture('get', suggest_url, main.airport_request_params(departures, searchfor), None, 200,
+                          json_header, airports)
+    main.save_fixture('post', vacancy_url, None, None, 302, {'location': 'en/booking/flight/vacancy.php?sid=1'}, '')
+    search_data = make_search_data(rows, tables=1 if return_date == 'oneway' else 2)
+    main.save_fixture('post', vacancy_url + '?sid=1', None,
+                      main.search_request_data(dep_iata, dest_iata, outbound_date, return_date), 200,
+                      json_header, json.dumps(search_data))
+
+
+class NullOutput(object):
+    """
+    stdout replacement to measure printing without terminal
+    """
+    def write(self, text):
+        pass
+
+    def flush(self):
+        pass
+
+
+def quiet(function):
+    """
+    Function return function running with stdout redirected to NullOutput
+    """
+    def run_quiet():
+        stdout, sys.stdout = sys.stdout, NullOutput()
+        try:
+            function()
+        finally:
+            sys.stdout = stdout
+    return run_quiet
+
+
+def run_pipeline(outbound_date, return_date):
+    """
+    Run flyniki_search once for replayed query, answering 'n' to question about next query
+    """
+    main.raw_input = lambda prompt='': 'n'
+    try:
+        main.flyniki_search(['main.py', 'DME', 'LON', outbound_date, return_date])
+    except SystemExit:
+        pass
+
+
+def bench_stages(name, rows, fixtures_path):
+    """
+    Print time of data_processing, format_result, print_mix_result and whole flyniki_search for synthetic page
+    """
+    outbound_date = main.format_date(datetime.date.today() + datetime.timedelta(days=30), 'to_str')
+    return_date = main.format_date(datetime.date.today() + datetime.timedelta(days=37), 'to_str')
+    search_data = make_search_data(rows)
+    search_html = lxml.html.fromstring(search_data['templates']['main'])
+    fares, parsed = main.data_processing(search_html, return_date)
+    flights = main.format_result(parsed, outbound_date, return_date)
+    currency, tax = main.get_currency_and_tax(search_data)
+    combinations = main.count_combinations(flights, fares, True)
+    write_fixtures(fixtures_path, rows, outbound_date, return_date)
+    repeat = 1 if rows >= 1000 else 3
+    stages = [('data_processing', 2 * rows, lambda: main.data_processing(search_html, return_date)),
+              ('format_result', 2 * rows, lambda: main.format_result(parsed, outbound_date, return_date)),
+              ('print_mix_result', combinations,
+               quiet(lambda: main.print_mix_result(flights, fares, currency, tax, 'DME - LON - DME', True))),
+              ('flyniki_search', combinations, quiet(lambda: run_pipeline(outbound_date, return_date)))]
+    for stage, count, function in stages:
+        seconds = measure(function, repeat)
+        print('{0: <20}{1: <10}{2: >10}{3: >12.4f}{4: >16,.0f}'.format(stage, name, count, seconds,
+                                                                     count / seconds))
+
+
+def load_server(url, query, clients, requests_count):
+    """
+    Send requests_count POST requests with query to url from clients threads,
+    return (seconds, Counter of response statuses)
+    """
+    statuses = collections.Counter()
+    lock = threading.Lock()
+    left = [requests_count]
+
+    def client():
+        session = requests.Session()
+        session.trust_env = False
+        while True:
+            with lock:
+                if not left[0]:
+                    return
+                left[0] -= 1
+            status = session.post(url, data=json.dumps(query)).status_code
+            with lock:
+                statuses[status] += 1
+    threads = [threading.Thread(target=client) for _ in xrange(clients)]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time.time() - start, statuses
+
+
+def bench_server(fixtures_path, clients=LOAD['clients'], requests_count=LOAD['requests'], rows=LOAD['rows']):
+    """
+    Print requests/s of search server for replayed round trip query with result cache off (cold) and on (warm)
+    """
+    outbound_date = main.format_date(datetime.date.today() + datetime.timedelta(days=30), 'to_str')
+    return_date = main.format_date(datetime.date.today() + datetime.timedelta(days=37), 'to_str')
+    write_fixtures(fixtures_path, rows, outbound_date, return_date)
+    query = {'dep_iata': 'DME', 'dest_iata': 'LON', 'outbound_date': outbound_date, 'return_date': return_date}
+    server = main.SearchServer(('127.0.0.1', 0), clients)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    url = 'http://127.0.0.1:%d/search' % server.server_address[1]
+    result_cache_ttl = main.RESULT_CACHE['ttl']
+    try:
+        for name, ttl in (('cold', 0), ('warm', 300)):
+            main.RESULT_CACHE['ttl'] = ttl
+            seconds, statuses = load_server(url, query, clients, requests_count)
+            print('{0: <20}{1: <10}{2: >10}{3: >12.4f}{4: >16,.0f}  {5}'.format(
+                'serve', name, requests_count, seconds, requests_count / seconds,
+                ' '.join('%d:%d' % status for status in sorted(statuses.items()))))
+    finally:
+        main.RESULT_CACHE['ttl'] = result_cache_ttl
+        server.shutdown()
+        server.server_close()
+
+
+def run(paths):
+    """
+    Run parser comparison on synthetic pages and saved responses, then time pipeline stages on synthetic pages
+    """
+    print('{0: <25}{1: >8}{2: >16}{3: >16}{4: >11}'.format('Page', 'Rows', 'Before rows/s', 'After rows/s',
+                                                          'Speedup'))
+    for name, rows in sorted(SIZES.items(), key=lambda (k, v): v):
+        bench_parser(name, make_search_data(rows))
+    for path in paths:
+        bench_parser(path[-25:], load_saved_response(path))
+    print('\n{0: <20}{1: <10}{2: >10}{3: >12}{4: >16}'.format('Stage', 'Page', 'Items', 'Seconds', 'Items/s'))
+    fixtures_path = tempfile.mkdtemp()
+    transport = dict(main.TRANSPORT)
+    airport_cache_path = main.AIRPORT_CACHE['path']
+    result_cache_ttl = main.RESULT_CACHE['ttl']
+    main.TRANSPORT['mode'] = 'replay'
+    main.RESULT_CACHE['ttl'] = 0
+    main.AIRPORT_CACHE['path'] = os.path.join(fixtures_path, 'airports.json')
+    try:
+        for name, rows in sorted(SIZES.items(), key=lambda (k, v): v):
+            bench_stages(name, rows, fixtures_path)
+        bench_server(fixtures_path)
+    finally:
+        main.TRANSPORT.update(transport)
+        main.AIRPORT_CACHE['path'] = airport_cache_path
+        main.RESULT_CACHE['ttl'] = result_cache_ttl
+        shutil.rmtree(fixtures_path)
+
+
+if __name__ == "__main__":
+    run(sys.argv[1:])
@@ -1,11 +1,195 @@
 """
 Scraper for fly niki
 """
+import os
 import sys
+import random
+import math
+import json
+import time
 import datetime
 import re
-import requests
-import lxml.html
+import csv
+import array
+import bisect
+import heapq
+import itertools
+import threading
+import collections
+import hashlib
+import sqlite3
+import importlib
+import traceback
+import Queue
+import urlparse
+import BaseHTTPServer
+import SocketServer
+
+
+class LazyModule(object):
+    """
+    Module proxy: module (and submodules) is imported at the first access to its attribute,
+    so -h, -check and queries with wrong parameters do not pay for import of requests and lxml
+    """
+    def __init__(self, name, submodules=()):
+        self._name = name
+        self._submodules = submodules
+        self._module = None
+
+    def __getattr__(self, attribute):
+        if self._module is None:
+            for name in self._submodules or (self._name,):
+                importlib.import_module(name)
+            self._module = sys.modules[self._name]
+        return getattr(self._module, attribute)
+
+
+class LazyXPath(object):
+    """
+    lxml.etree.XPath compiled at the first call
+    """
+    def __init__(self, path, **kwargs):
+        self.path = path
+        self.kwargs = kwargs
+        self.xpath = None
+
+    def __call__(self, *args, **kwargs):
+        if self.xpath is None:
+            self.xpath = lxml.etree.XPath(self.path, **self.kwargs)
+        return self.xpath(*args, **kwargs)
+
+
+requests = LazyModule('requests', ('requests.adapters',))
+lxml = LazyModule('lxml', ('lxml.etree', 'lxml.html'))
+
+
+AIRPORT_CACHE = {'ttl': 24 * 60 * 60,
+                 'stale_ttl': 7 * 24 * 60 * 60,
+                 'max_entries': 1024,
+                 'offline': False,
+                 'path': os.path.join(os.path.expanduser('~'), '.flyniki', 'airports.json')}
+
+_airport_cache = collections.OrderedDict()
+_airport_cache_lock = threading.Lock()
+_airport_cache_state = {'loaded': False, 'refreshing': set(), 'dirty': False, 'saving': False}
+
+BATCH = {'workers': 8,
+         'per_host': 4}
+
+_host_slots = {}
+_host_slots_lock = threading.Lock()
+
+_fare_names = {}
+
+STATS = {'enabled': False,
+         'dump_path': None}
+
+_stats = {'timers': {}, 'counters': {}, 'hooks': []}
+_stats_lock = threading.Lock()
+
+MIN_CONNECTION_TIME = datetime.timedelta(hours=1)
+
+CALENDAR = {'overview_days': 7,
+            'max_days': 62}
+
+CONNECTIONS = {'max_stops': 2,
+               'max_layover': datetime.timedelta(hours=24),
+               'max_paths': 200,
+               'top': 10}
+
+WATCH = {'interval': 15 * 60,
+         'jitter': 0.1}
+
+HISTORY = {'enabled': False,
+           'path': 'fare_history.sqlite',
+           'last': 10}
+_history = {'connection': None}
+_history_lock = threading.Lock()
+HISTORY_SCHEMA = """
+CREATE TABLE IF NOT EXISTS scrapes (id INTEGER PRIMARY KEY, route TEXT NOT NULL, query_date TEXT NOT NULL,
+                                    scraped_at REAL NOT NULL, currency TEXT, tax REAL);
+CREATE TABLE IF NOT EXISTS prices (scrape_id INTEGER NOT NULL, route TEXT NOT NULL, travel_date TEXT NOT NULL,
+                                   departure TEXT NOT NULL, arrival TEXT NOT NULL, fare TEXT NOT NULL,
+                                   price REAL NOT NULL);
+CREATE INDEX IF NOT EXISTS scrapes_route ON scrapes (route, id);
+CREATE INDEX IF NOT EXISTS prices_route_scrape ON prices (route, scrape_id);
+CREATE INDEX IF NOT EXISTS prices_route_date ON prices (route, travel_date, fare, scrape_id);
+"""
+
+SERVER = {'host': '127.0.0.1',
+          'port': 8080,
+          'max_requests': 32,
+          'top': 50}
+
+RECORD_FIELDS = ('route', 'outbound_departure', 'outbound_arrival', 'outbound_duration', 'outbound_fare',
+                 'outbound_price', 'return_departure', 'return_arrival', 'return_duration', 'return_fare',
+                 'return_price', 'total_price', 'total_price_with_tax', 'currency')
+
+OUTPUT_FORMATS = ('text', 'jsonl', 'csv')
+
+NUMERIC_OPTIONS = {'workers': (int, 1),
+                   'per-host': (int, 1),
+                   'top': (int, 0),
+                   'cache-ttl': (int, 0),
+                   'retries': (int, 0),
+                   'stay': (int, 0),
+                   'stops': (int, 0),
+                   'rounds': (int, 1),
+                   'interval': (float, 0),
+                   'jitter': (float, 0),
+                   'last': (int, 0),
+                   'port': (int, 0),
+                   'max-requests': (int, 1)}
+
+TEMPLATES = ('main', 'priceoverview', 'infos', 'flightinfo', 'dateoverview')
+LEAN_TEMPLATES = ('main', 'priceoverview', 'dateoverview')
+
+SEARCH = {'templates': TEMPLATES}
+
+RESULT_CACHE = {'ttl': 5 * 60,
+                'max_entries': 256}
+
+_result_cache = collections.OrderedDict()
+_result_cache_lock = threading.Lock()
+_result_cache_state = {'hits': 0, 'misses': 0, 'coalesced': 0, 'in_flight': {}}
+
+HTTP = {'pool_connections': 2,
+        'pool_maxsize': 16,
+        'timeout': (5, 30),
+        'search_url_ttl': 10 * 60}
+
+_http_state = {'session': None, 'search_urls': {}}
+_http_lock = threading.Lock()
+
+RATE_LIMIT = {'endpoints': {'suggestAirport.php': 'suggest', 'vacancy.php': 'search'},
+              'budgets': {'suggest': (10.0, 20), 'search': (4.0, 8)},
+              'retries': 3,
+              'backoff': 0.5,
+              'max_backoff': 30.0,
+              'retry_statuses': (429, 500, 502, 503, 504),
+              'slow': 10.0,
+              'decrease': 0.5}
+
+_rate_buckets = {}
+_rate_buckets_lock = threading.Lock()
+
+TRANSPORT = {'mode': 'live',
+             'path': 'fixtures'}
+
+FARE_TYPES_XPATH = LazyXPath('//*[@class="faretypes"]')
+FARE_NAMES_XPATH = LazyXPath('.//td/div[1]/label/p/text()', smart_strings=False)
+FLIGHT_TABLES_XPATH = LazyXPath('//*[@class="flighttable"]')
+FLIGHT_ROWS_XPATH = LazyXPath('.//*[@class="flightrow" or @class="flightrow selected"]')
+PAGE_INFO_XPATH = LazyXPath('(//*[@class="vacancy_route"])[1]|(//*[@value="COMF"])[1]')
+TAX_XPATH = LazyXPath('//*[@class="additionals-tsc"]/td[2]/text()')
+OVERVIEW_DATES_XPATH = LazyXPath('//*[@data-date]|//input[@value]')
+ROW_CELLS_XPATH = LazyXPath('td')
+DEPARTURE_TIME_XPATH = LazyXPath('string(span/time[1])')
+ARRIVAL_TIME_XPATH = LazyXPath('string(span/time[2])')
+DAYS_XPATH = LazyXPath('string(span/strong)')
+SPAN_XPATH = LazyXPath('string(span)')
+PRICE_XPATH = LazyXPath('string(label/div[2]/span)')
+LOW_PRICE_XPATH = LazyXPath('string(label/div[1]/span)')
 
 
 class ParametersError(RuntimeError):
@@ -22,10 +206,201 @@ class SearchError(RuntimeError):
     pass
 
 
+class NoConnectionsError(SearchError):
+    """
+    class for search without flights on the entered date
+    """
+    pass
+
+
+class Stage(object):
+    """
+    Timer of pipeline stage, used as context manager: with stage('parse_html'): ...
+    """
+    __slots__ = ('name', 'started')
+
+    def __init__(self, name):
+        self.name = name
+        self.started = None
+
+    def __enter__(self):
+        self.started = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        record_time(self.name, time.time() - self.started)
+        return False
+
+
+class NoStage(object):
+    """
+    Stage which does nothing, returned by stage() when stats are disabled
+    """
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+NO_STAGE = NoStage()
+
+
+class TokenBucket(object):
+    """
+    Token bucket rate limiter: rate requests per second on average, up to burst requests at once
+    """
+    def __init__(self, rate, burst):
+        self.rate = float(rate)
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.time()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Take one token, sleep until it is available. return seconds of sleep
+        """
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate) - 1
+            self.updated = now
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait:
+            time.sleep(wait)
+        return wait
+
+
+class AdaptiveLimiter(object):
+    """
+    AIMD limit of simultaneous requests: limit grows by 1 after about limit good responses (up to max_limit)
+    and is multiplied by RATE_LIMIT['decrease'] (down to 1) after error or response slower than RATE_LIMIT['slow']
+    """
+    def __init__(self, max_limit):
+        self.max_limit = max_limit
+        self.limit = float(max_limit)
+        self.in_flight = 0
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        with self.condition:
+            while self.in_flight >= int(self.limit):
+                self.condition.wait()
+            self.in_flight += 1
+
+    def release(self, success):
+        with self.condition:
+            self.in_flight -= 1
+            if success:
+                self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+            else:
+                self.limit = max(1.0, self.limit * RATE_LIMIT['decrease'])
+            self.condition.notify_all()
+
+
+class SearchRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    JSON API of search server: POST /search, GET /stats, GET /health (see serve)
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        if self.path == '/health':
+            self.send_json(200, {'status': 'ok'})
+        elif self.path == '/stats':
+            self.send_json(200, get_stats())
+        else:
+            self.send_json(404, {'error': 'Unknown path %s' % self.path})
+
+    def do_POST(self):
+        try:
+            body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        except ValueError:
+            self.close_connection = True
+            self.send_json(400, {'error': 'Wrong Content-Length'})
+            return
+        if self.path != '/search':
+            self.send_json(404, {'error': 'Unknown path %s' % self.path})
+            return
+        try:
+            query = json.loads(body or '{}')
+        except ValueError:
+            self.send_json(400, {'error': 'Request body must be JSON object'})
+            return
+        if not self.server.slots.acquire(False):
+            self.send_json(503, {'error': 'Too many requests'}, {'Retry-After': '1'})
+            return
+        try:
+            response = serve_search(query)
+        except Exception:
+            sys.stderr.write(traceback.format_exc())
+            response = 500, {'error': 'Internal server error'}
+        finally:
+            self.server.slots.release()
+        self.send_json(*response)
+
+    def send_json(self, status, body, headers=None):
+        """
+        Send body as JSON response
+        """
+        body = json.dumps(body)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, log_format, *args):
+        pass
+
+
+class SearchServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """
+    Threaded HTTP server with limited number of searches at a time (SERVER['max_requests'])
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, max_requests=None):
+        BaseHTTPServer.HTTPServer.__init__(self, address, SearchRequestHandler)
+        self.slots = threading.BoundedSemaphore(max_requests or SERVER['max_requests'])
+
+
+class Flight(object):
+    """
+    Flight record: departure and arrival datetime, duration string and prices - array of floats,
+    one price for each fare type of the table (0 if price 'notbookable')
+    """
+    __slots__ = ('departure', 'arrival', 'duration', 'prices')
+
+    def __init__(self, departure, arrival, duration, prices):
+        self.departure = departure
+        self.arrival = arrival
+        self.duration = duration
+        self.prices = array.array('d', prices)
+
+    def __repr__(self):
+        return 'Flight(%r, %r, %r, %r)' % (self.departure, self.arrival, self.duration, list(self.prices))
+
+    def as_dict(self, fares):
+        """
+        return flight as dict with datetimes in DD.MM.YY HH:MM format and prices {fare: price} without notbookable
+        """
+        return {'departure': format_date(self.departure, 'from_datetime'),
+                'arrival': format_date(self.arrival, 'from_datetime'),
+                'duration': self.duration,
+                'prices': dict((fare, price) for fare, price in zip(fares, self.prices) if price)}
+
+
 def check_search_parameters(search_parameters, check_iata_online=True):
     """
     Function return parameters for search request at flyniki.com.
-    Use optional argument check_iata_online = False to not online checking IATA
+    Use optional argument check_iata_online = False to not online checking IATA.
+    IATA codes are checked online only if all parameters pass local checks of format and dates
     """
     while True:
         count_errs = 0
@@ -34,8 +409,10 @@ def check_search_parameters(search_parameters, check_iata_online=True):
             search_parameters.append('oneway')
         check_numbers_of_parameters(search_parameters)
         search_parameters[0], search_parameters[1] = check_iata(search_parameters[0].upper(),
-                                                                search_parameters[1].upper(), check_iata_online)
+                                                                search_parameters[1].upper(), False)
         search_parameters[2], search_parameters[3] = check_dates(search_parameters[2], search_parameters[3])
+        if all(search_parameters) and check_iata_online:
+            search_parameters[0], search_parameters[1] = check_iata(search_parameters[0], search_parameters[1], True)
         if all(search_parameters):
             return search_parameters
         for index, elem in enumerate(search_parameters):
@@ -65,84 +442,173 @@ def check_numbers_of_parameters(search_parameters):
                               '[return date]\nThe last parameter is not required for oneway flight search.'
                               '\nIATA code contains 3 uppercase letters. Enter -iata to see the list of available '
                               'airports codes.\nDates must be at DD.MM.YY format.Examples of valid query:'
-                              '\nDME LON 17.04.17 06.05.17\nBER ROM 29.08.17')
+                              '\nDME LON 17.04.17 06.05.17\nBER ROM 29.08.17'
+                              '\nEnter -prefetch to download and cache the whole Fly Niki route graph.'
+                              '\nEnter -batch [file] [--workers=N] [--per-host=N] to run CSV or JSON Lines queries '
+                              'from the file (or stdin) without questions.'
+                              '\nAdd --top=N to see only N the cheapest round trip options, --format=jsonl or '
+                              '--format=csv to get records instead of the table.'
+                              '\nEnter -calendar DEP DEST FIRST_DATE LAST_DATE (or DEP DEST DATE +-N) [--stay=N] '
+                              'to see the lowest price of each day, round trip with --stay days.'
+                              '\nEnter -connections DEP DEST DATE [--stops=N] [--top=N] to search flights with stops.'
+                              '\nEnter -watch [file] [--interval=SECONDS] to poll queries and get fare changes.'
+                              '\nEnter -serve [--port=N] to run local JSON search server.'
+                              '\nEnter -history DEP DEST [DD.MM.YY] to see prices saved with --history.'
+                              '\nEnter -check [file] to validate queries offline against the airport snapshot '
+                              '(see -prefetch, --airports=PATH), add --offline to search without checking online.'
+                              '\nAdd --rate=search:4/8,suggest:10 to set requests per second (and burst) of '
+                              'flyniki.com endpoints, --retries=N and --per-host=N for retries and parallel requests.'
+                              '\nAdd --record=DIR to save responses of flyniki.com, --replay=DIR to use saved ones.'
+                              '\nAdd --lean to ask flyniki.com only for the templates used in the output and '
+                              'error checks.'
+                              '\nAdd --profile to see time of each stage, --stats-file=PATH to save stats '
+                              '(JSON for .json, else Prometheus text).')
     if keyword in ['-iata', 'iata']:
         get_airports_from_site(show=True)
         raise ParametersError('This is list of IATA codes sorted by a name of airport city')
+    if keyword in ['-prefetch', 'prefetch']:
+        routes = prefetch_route_graph()
+        raise ParametersError('\nRoute graph cached: %d departure airports, %d routes'
+                              % (len(routes), sum(len(dest) for dest in routes.values())))
     if parameters not in (3, 4):
         raise ParametersError('\nWrong number of parametres - you have entered %d, and should be 3 or 4' % parameters)
 
 
-def check_iata(dep_iata, dest_iata, check_iata_online):
+def validate_query(search_parameters, check_iata_online=True):
+    """
+    Non-interactive version of check_search_parameters. Never asks user and never exits,
+    raise ParametersError with all found errors instead. Query failing local checks is not checked online.
+    """
+    if not all(isinstance(elem, basestring) for elem in search_parameters):
+        raise ParametersError('Parameters of query must be strings')
+    search_parameters = [elem.strip() for elem in search_parameters if elem and elem.strip()]
+    if len(search_parameters) == 3:
+        search_parameters.append('oneway')
+    if len(search_parameters) != 4:
+        raise ParametersError('Wrong number of parametres - you have entered %d, and should be 3 or 4'
+                              % len(search_parameters))
+    errors = []
+    search_parameters[0], search_parameters[1] = check_iata(search_parameters[0].upper(),
+                                                            search_parameters[1].upper(), False, errors)
+    search_parameters[2], search_parameters[3] = check_dates(search_parameters[2], search_parameters[3],
+                                                             errors=errors)
+    if not errors and check_iata_online:
+        search_parameters[0], search_parameters[1] = check_iata(search_parameters[0], search_parameters[1], True,
+                                                                errors)
+    if errors:
+        raise ParametersError(' '.join(errors))
+    return search_parameters
+
+
+def check_iata(dep_iata, dest_iata, check_iata_online, errors=None):
     """
     Function to check IATA codes at search query: (3 uppercase letters, dest_iata do not match dep_iata)
     If check_iata_online = True also checks: Availability dest_iata and dep_iata on flyniki.com,
     availability route dest_iata-dep_iata
+    Error messages are printed, or appended to errors if it is a list
     """
     if re.match("[A-Z]{3}$", dep_iata) is None:
-        print('\nIncorrect departure airport IATA code format %s. Use AAA format.' % dep_iata)
+        report_error(errors, '\nIncorrect departure airport IATA code format %s. Use AAA format.' % dep_iata)
         dep_iata = False
     else:
         if check_iata_online:
             if dep_iata not in get_airports_from_site():
-                print('\nDeparture airport IATA code %s not found on flyniki.com' % dep_iata)
+                report_error(errors, '\nDeparture airport IATA code %s not found on flyniki.com' % dep_iata)
                 dep_iata = False
     if re.match("[A-Z]{3}$", dest_iata) is None:
-        print('\nIncorrect destination airport IATA code format %s. Use AAA format.' % dest_iata)
+        report_error(errors, '\nIncorrect destination airport IATA code format %s. Use AAA format.' % dest_iata)
         dest_iata = False
     else:
         if dest_iata == dep_iata:
-            print('\nDestination airport IATA code is the same as at the departure airport, you do not need a flight')
+            report_error(errors, '\nDestination airport IATA code is the same as at the departure airport, '
+                                 'you do not need a flight')
             dest_iata = False
         else:
             if check_iata_online:
                 if dest_iata not in get_airports_from_site(searchfor='destinations'):
-                    print('\nDestinations airport IATA code %s not found on flyniki.com' % dest_iata)
+                    report_error(errors,
+                                 '\nDestinations airport IATA code %s not found on flyniki.com' % dest_iata)
                     dest_iata = False
                 else:
                     if dep_iata and dest_iata not in get_airports_from_site(dep_iata, 'destinations'):
-                        print('\nIncorrect destination airport. Fly Niki does not carry out flights on a '
-                              'given route %s - %s' % (dep_iata, dest_iata))
+                        report_error(errors, '\nIncorrect destination airport. Fly Niki does not carry out '
+                                             'flights on a given route %s - %s' % (dep_iata, dest_iata))
                         dest_iata = False
     return dep_iata, dest_iata
 
 
-def check_dates(outbound_date, return_date, delta=360):
+def check_dates(outbound_date, return_date, delta=360, errors=None):
     """
     Function to check dates at search query: (correct format, max_date >= dest_date >= dep_date >=today)
     max_date = today + delta
+    Error messages are printed, or appended to errors if it is a list
     """
     max_date = datetime.date.today() + datetime.timedelta(days=delta)
     try:
         dep_date = format_date(outbound_date, 'to_date')
         if dep_date < datetime.date.today():
-            print('\nIncorrect departure date %s. It must be at least %s'
-                  % (outbound_date, format_date(datetime.date.today(), 'to_str')))
+            report_error(errors, '\nIncorrect departure date %s. It must be at least %s'
+                         % (outbound_date, format_date(datetime.date.today(), 'to_str')))
             outbound_date = False
         if dep_date > max_date:
-            print('\nIncorrect departure date %s. It must be earlier than %s'
-                  % (outbound_date, format_date(max_date, 'to_str')))
+            report_error(errors, '\nIncorrect departure date %s. It must be earlier than %s'
+                         % (outbound_date, format_date(max_date, 'to_str')))
             outbound_date = False
     except ValueError:
-        print('\nIncorrect departure date format %s. Use DD.MM.YY' % outbound_date)
+        report_error(errors, '\nIncorrect departure date format %s. Use DD.MM.YY' % outbound_date)
         outbound_date = False
     if return_date != 'oneway':
         try:
             ret_date = format_date(return_date, 'to_date')
             if outbound_date and ret_date < format_date(outbound_date, 'to_date'):
-                print('\nReturn date %s earlier the date of departure. It must be at least %s'
-                      % (return_date, outbound_date))
+                report_error(errors, '\nReturn date %s earlier the date of departure. It must be at least %s'
+                             % (return_date, outbound_date))
                 return_date = False
             if ret_date > max_date:
-                print('\nIncorrect return date %s. It must be earlier than %s'
-                      % (return_date, format_date(max_date, 'to_str')))
+                report_error(errors, '\nIncorrect return date %s. It must be earlier than %s'
+                             % (return_date, format_date(max_date, 'to_str')))
                 return_date = False
         except ValueError:
-            print('\nIncorrect return date format %s. Use DD.MM.YY' % return_date)
+            report_error(errors, '\nIncorrect return date format %s. Use DD.MM.YY' % return_date)
             return_date = False
     return outbound_date, return_date
 
 
+def report_error(errors, message):
+    """
+    Function to print error message of search parameters, or to collect it in errors list (non-interactive mode)
+    """
+    if errors is None:
+        print(message)
+    else:
+        errors.append(message.strip())
+
+
+def search_errors():
+    """
+    Function return tuple of expected errors of search: in parameters, in search result, no response and
+    wrong data format of flyniki.com (see error_message).
+    Errors of requests can not be raised before it is imported, so it is not imported here
+    """
+    errors = (ParametersError, SearchError, ValueError, KeyError, IndexError, TypeError)
+    if 'requests' in sys.modules:
+        errors = (requests.RequestException,) + errors
+    return errors
+
+
+def error_message(err):
+    """
+    Function return (message, HTTP status) for one of search_errors()
+    """
+    if isinstance(err, ParametersError):
+        return str(err).strip(), 400
+    if isinstance(err, SearchError):
+        return str(err).strip(), 404
+    if 'requests' in sys.modules and isinstance(err, requests.RequestException):
+        return 'No response from www.flyniki.com', 502
+    return 'Wrong data format from www.flyniki.com', 502
+
+
 def format_date(date, to_type):
     """
     Formating date
@@ -156,35 +622,31 @@ def format_date(date, to_type):
         return datetime.date.strftime(date, '%Y-%m-%d')
     if to_type == 'to_datetime':
         return datetime.datetime.strptime(date, '%d.%m.%y %H:%M')
+    if to_type == 'from_datetime':
+        return datetime.datetime.strftime(date, '%d.%m.%y %H:%M')
+
+
+def intern_fare(fare):
+    """
+    Function return one shared string object for each fare name
+    """
+    fare = unicode(fare)
+    return _fare_names.setdefault(fare, fare)
 
 
-def get_airports_from_site(departures='', searchfor='departures', show=False):
+def get_airports_from_site(departures='', searchfor='departures', show=False, use_cache=True):
     """
-    Function takes 3 optional arguments. By default function return list of all Fly Niki departures airports.
+    Function takes 4 optional arguments. By default function return list of all Fly Niki departures airports.
     Use searchfor='destinations' to return list of all Fly Niki destinations airports
     Use dep_iata = 'IATA code departure airport' and searchfor='destinations' to return list of all available
     airports for flights from departure airport.
     Use show = True to print result list of airports on the screen
+    Use use_cache = False to bypass the airport cache and always ask flyniki.com
     """
-    airport_request_params = {'searchfor': searchfor,
-                              'searchflightid': '0',
-                              'departures[]': departures,
-                              'destinations[]': '',
-                              'suggestsource[0]': 'activeairports',
-                              'withcountries': '0',
-                              'withoutroutings': '0',
-                              'promotion[id]': '',
-                              'promotion[type]': '',
-                              'get_full_suggest_list': 'true',
-                              'routesource[0]': 'airberlin',
-                              'routesource[1]': 'partner'}
-    airports = {}
-    airport_request = requests.get('http://www.flyniki.com/en/site/json/suggestAirport.php',
-                                   params=airport_request_params)
-    for airport in tuple(airport_request.json()['suggestList']):
-        airports[airport['code']] = airport['name']
-    if not airports:
-        raise TypeError('Failed to obtain list of airports')
+    if use_cache:
+        airports = get_cached_airports(departures, searchfor)
+    else:
+        airports = load_airports_from_site(departures, searchfor)
     if show:
         help_iata = ''
         for index, elem in enumerate(sorted(airports.items(), key=lambda (k, v): v)):
@@ -198,11 +660,211 @@ def get_airports_from_site(departures='', searchfor='departures', show=False):
     return airports
 
 
-def get_search_data(dep_iata, dest_iata, outbound_date, return_date, lang='en', shop='RU'):
+def load_airports_from_site(departures='', searchfor='departures'):
+    """
+    Function to get dict {IATA code: airport name} from suggestAirport.php, without any caching
+    """
+    airports = {}
+    with stage('airports_request'):
+        airport_request = site_request('get', 'http://www.flyniki.com/en/site/json/suggestAirport.php',
+                                       params=airport_request_params(departures, searchfor))
+    for airport in tuple(airport_request.json()['suggestList']):
+        airports[airport['code']] = airport['name']
+    if not airports:
+        raise TypeError('Failed to obtain list of airports')
+    return airports
+
+
+def airport_request_params(departures='', searchfor='departures'):
+    """
+    Function return parameters of suggestAirport.php request
+    """
+    return {'searchfor': searchfor,
+            'searchflightid': '0',
+            'departures[]': departures,
+            'destinations[]': '',
+            'suggestsource[0]': 'activeairports',
+            'withcountries': '0',
+            'withoutroutings': '0',
+            'promotion[id]': '',
+            'promotion[type]': '',
+            'get_full_suggest_list': 'true',
+            'routesource[0]': 'airberlin',
+            'routesource[1]': 'partner'}
+
+
+def get_cached_airports(departures='', searchfor='departures', save=True):
+    """
+    Function return airports list from the cache (memory LRU, then disk store) or from flyniki.com.
+    Entry younger than AIRPORT_CACHE['ttl'] is returned as is. Entry older than ttl, but younger than
+    ttl + stale_ttl is returned at once and refreshed in background (stale-while-revalidate).
+    Older or missing entry is loaded from flyniki.com synchronously.
+    With AIRPORT_CACHE['offline'] entry of any age is returned and flyniki.com is never asked,
+    missing entry raise ParametersError. Use save = False to not write loaded entry to disk at once
+    (see store_airports)
+    """
+    key = searchfor + ':' + departures
+    with _airport_cache_lock:
+        if not _airport_cache_state['loaded']:
+            load_airport_cache()
+        entry = _airport_cache.pop(key, None)
+        if entry is not None:
+            _airport_cache[key] = entry
+    if entry is not None:
+        age = time.time() - entry[0]
+        if age < AIRPORT_CACHE['ttl'] or AIRPORT_CACHE['offline']:
+            count('airport_cache_hits')
+            return entry[1]
+        if age < AIRPORT_CACHE['ttl'] + AIRPORT_CACHE['stale_ttl']:
+            count('airport_cache_hits')
+            count('airport_cache_stale')
+            refresh_airports_in_background(departures, searchfor)
+            return entry[1]
+    count('airport_cache_misses')
+    if AIRPORT_CACHE['offline']:
+        raise ParametersError('\nNo %s in airport snapshot %s, run -prefetch to save it'
+                              % (searchfor + (' from ' + departures if departures else ''), AIRPORT_CACHE['path']))
+    airports = load_airports_from_site(departures, searchfor)
+    store_airports(key, airports, save)
+    return airports
+
+
+def refresh_airports_in_background(departures, searchfor):
+    """
+    Function to reload stale airports list in a daemon thread. Only one refresh per key at a time,
+    on errors the stale entry is kept
+    """
+    key = searchfor + ':' + departures
+    with _airport_cache_lock:
+        if key in _airport_cache_state['refreshing']:
+            return
+        _airport_cache_state['refreshing'].add(key)
+
+    def refresh():
+        try:
+            store_airports(key, load_airports_from_site(departures, searchfor))
+        except (requests.RequestException, ValueError, KeyError, TypeError):
+            pass
+        finally:
+            with _airport_cache_lock:
+                _airport_cache_state['refreshing'].discard(key)
+
+    thread = threading.Thread(target=refresh)
+    thread.daemon = True
+    thread.start()
+
+
+def store_airports(key, airports, save=True):
+    """
+    Function to put airports list into memory LRU and (if save = True) write the cache to disk
+    """
+    with _airport_cache_lock:
+        _airport_cache.pop(key, None)
+        _airport_cache[key] = (time.time(), airports)
+        while len(_airport_cache) > AIRPORT_CACHE['max_entries']:
+            _airport_cache.popitem(last=False)
+        _airport_cache_state['dirty'] = True
+    if save:
+        save_airport_cache()
+
+
+def load_airport_cache():
+    """
+    Function to read disk store of airports into memory LRU. Must be called under _airport_cache_lock
+    """
+    _airport_cache_state['loaded'] = True
+    try:
+        with open(AIRPORT_CACHE['path']) as cache_file:
+            entries = json.load(cache_file)
+    except (IOError, OSError, ValueError):
+        return
+    for key, entry in sorted(entries.items(), key=lambda (k, v): v[0]):
+        _airport_cache[key] = (entry[0], entry[1])
+    while len(_airport_cache) > AIRPORT_CACHE['max_entries']:
+        _airport_cache.popitem(last=False)
+
+
+def save_airport_cache():
+    """
+    Function to write memory LRU of airports to disk store if it was changed by store_airports.
+    Must be called without _airport_cache_lock: entries are copied under the lock and written after it is released.
+    Only one thread writes at a time, changes made during the write are written by the same thread once more
+    """
+    with _airport_cache_lock:
+        if _airport_cache_state['saving'] or not _airport_cache_state['dirty']:
+            return
+        _airport_cache_state['saving'] = True
+    try:
+        while True:
+            with _airport_cache_lock:
+                if not _airport_cache_state['dirty']:
+                    _airport_cache_state['saving'] = False
+                    return
+                _airport_cache_state['dirty'] = False
+                entries = dict((key, list(entry)) for key, entry in _airport_cache.items())
+            write_airport_cache(AIRPORT_CACHE['path'], entries)
+    except Exception:
+        with _airport_cache_lock:
+            _airport_cache_state['saving'] = False
+        raise
+
+
+def write_airport_cache(path, entries):
+    """
+    Function to write entries of airport cache to path through temporary file, errors are ignored
+    """
+    try:
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path + '.tmp', 'w') as cache_file:
+            json.dump(entries, cache_file)
+        os.rename(path + '.tmp', path)
+    except (IOError, OSError):
+        pass
+
+
+def prefetch_route_graph():
+    """
+    Function to load all departures airports and destinations from each of them into the cache.
+    return routes = {departure IATA code: [destination IATA codes]}
+    """
+    routes = {}
+    departures = load_airports_from_site()
+    store_airports('departures:', departures, save=False)
+    store_airports('destinations:', load_airports_from_site(searchfor='destinations'), save=False)
+    for dep_iata in sorted(departures):
+        destinations = load_airports_from_site(dep_iata, 'destinations')
+        store_airports('destinations:' + dep_iata, destinations, save=False)
+        routes[dep_iata] = sorted(destinations)
+    save_airport_cache()
+    return routes
+
+
+def get_search_data(dep_iata, dest_iata, outbound_date, return_date, lang='en', shop='RU', templates=None):
     """
     Function to get data from site.
+    Redirect target of vacancy.php is reused while it is valid (see get_search_url)
+    templates - names of templates to ask (SEARCH['templates'] by default)
+    """
+    request_data = search_request_data(dep_iata, dest_iata, outbound_date, return_date, templates)
+    cookie = {'remember': '0%3B' + lang + '0%3B' + shop}
+    search_url, cached = get_search_url(lang, shop)
+    with stage('search_request'):
+        search_request = site_request('post', search_url, data=request_data, cookies=cookie,
+                                      allow_redirects=not cached)
+    if cached and (search_request.status_code != 200 or search_request.is_redirect):
+        count('search_url_expired')
+        search_url = get_search_url(lang, shop, refresh=True)[0]
+        with stage('search_request'):
+            search_request = site_request('post', search_url, data=request_data, cookies=cookie)
+    return search_request
+
+
+def search_request_data(dep_iata, dest_iata, outbound_date, return_date, templates=None):
+    """
+    Function return form data of the search request, templates - names of templates to ask
+    (SEARCH['templates'] by default)
     """
-    session = requests.Session()
     outbound_date = format_date(outbound_date, 'to_flyniki')
     if return_date == 'oneway':
         return_date = ''
@@ -210,240 +872,1738 @@ def get_search_data(dep_iata, dest_iata, outbound_date, return_date, lang='en',
     else:
         return_date = format_date(return_date, 'to_flyniki')
         oneway = ''
-    request_data = [('_ajax[templates][]', 'main'),
-                    ('_ajax[templates][]', 'priceoverview'),
-                    ('_ajax[templates][]', 'infos'),
-                    ('_ajax[templates][]', 'flightinfo'),
-                    ('_ajax[requestParams][departure]', dep_iata),
-                    ('_ajax[requestParams][destination]', dest_iata),
-                    ('_ajax[requestParams][returnDeparture]', ''),
-                    ('_ajax[requestParams][returnDestination]', ''),
-                    ('_ajax[requestParams][outboundDate]', outbound_date),
-                    ('_ajax[requestParams][returnDate]', return_date),
-                    ('_ajax[requestParams][adultCount]', '1'),
-                    ('_ajax[requestParams][childCount]', '0'),
-                    ('_ajax[requestParams][infantCount]', '0'),
-                    ('_ajax[requestParams][openDateOverview]', ''),
-                    ('_ajax[requestParams][oneway]', oneway),
-                    ('_ajax[templates][])', 'dateoverview')]
-    cookie = {'remember': '0%3B' + lang + '0%3B' + shop}
-    search_request = session.post('http://www.flyniki.com/' + lang + '/booking/flight/vacancy.php',
-                                  cookies=cookie, allow_redirects=False)
-    search_url = 'http://www.flyniki.com/' + search_request.headers['location']
-    return session.post(search_url, data=request_data)
+    templates = SEARCH['templates'] if templates is None else templates
+    request_data = [('_ajax[templates][]', template) for template in templates]
+    return request_data + [('_ajax[requestParams][departure]', dep_iata),
+                           ('_ajax[requestParams][destination]', dest_iata),
+                           ('_ajax[requestParams][returnDeparture]', ''),
+                           ('_ajax[requestParams][returnDestination]', ''),
+                           ('_ajax[requestParams][outboundDate]', outbound_date),
+                           ('_ajax[requestParams][returnDate]', return_date),
+                           ('_ajax[requestParams][adultCount]', '1'),
+                           ('_ajax[requestParams][childCount]', '0'),
+                           ('_ajax[requestParams][infantCount]', '0'),
+                           ('_ajax[requestParams][openDateOverview]', ''),
+                           ('_ajax[requestParams][oneway]', oneway)]
 
 
-def check_for_result_errors(search_data):
+def required_templates(*extra):
     """
-    Function to checking data for errors and result availability
+    Function return SEARCH['templates'] with extra templates needed by caller, in order of TEMPLATES
     """
-    if 'error' in search_data:
-        err_msg = lxml.html.fromstring(search_data['error']).xpath('string(//*[@class = "wrapper"])')
-        raise SearchError('\n' + err_msg.encode(sys.getdefaultencoding(), 'replace'))
-    if 'No connections' in search_data['templates']['dateoverview']:
-        raise SearchError('\nNo connections found for the entered data. '
-                          'However, connections are available on days either side. Keep searching!')
+    return tuple(template for template in TEMPLATES if template in SEARCH['templates'] or template in extra)
 
 
-def data_processing(search_html, return_date):
+def get_template_tree(search_data, name):
     """
-    The gathering of information on flights from the received data. flights = [outbound table, return table].
-    Each table list of: [departure time, arrival time, difference in days, duration, [price1, price2,...]].
-    Price is selected from two possible (current and lowest), defaults to the current, but sometimes it does not exist.
-    If price 'notbookable' - price = 0
-    fare_types = [[outbound fare types][return fare types]]. Each table list of used cabin classes.
+    Function return parsed template name of search data. Each template is parsed at most once,
+    trees are kept in search_data['trees']
     """
-    fare_types = []
-    flights = []
-    flight_tables = 1 if return_date == 'oneway' else 2
-    for table in xrange(1, flight_tables+1):
-        flights.append([])
-        fare_types.append(search_html.xpath('(//*[@class="faretypes"])[{}]//td/div[1]/label/p/text()'.format(table)))
-        fly_rows = search_html.xpath('(//*[@class="flighttable"])[{0}]//*[@class="flightrow"]'
-                                     '|(//*[@class="flighttable"])[{0}]//*[@class="flightrow selected"]'.format(table))
-        for index, row in enumerate(fly_rows):
-            flights[table-1].append([])
-            flights[table-1][index].append(str(row.xpath('string(td[2]/span/time[1])')))
-            flights[table-1][index].append(str(row.xpath('string(td[2]/span/time[2])')))
-            flights[table-1][index].append(str(row.xpath('string(td[2]/span/strong)')))
-            flights[table-1][index].append(str(row.xpath('string(td[4]/span)')))
-            for td in xrange(5, 5+len(fare_types[table-1])):
-                if len(row.xpath('string(td[{}]/span)'.format(td))) == 0:
-                    price = row.xpath('string(td[{}]/label/div[2]/span)'.format(td))
-                    low_price = row.xpath('string(td[{}]/label/div[1]/span)'.format(td))
-                    if len(price) == 0:
-                        price = low_price
-                    flights[table-1][index].append(str(price))
-                else:
-                    flights[table-1][index].append('0')
-    return fare_types, flights
+    trees = search_data.setdefault('trees', {})
+    if name not in trees:
+        with stage('parse_html'):
+            trees[name] = lxml.html.fromstring(search_data['templates'][name])
+    return trees[name]
 
 
-def format_result(flights, outbound_date, return_date):
+def get_search_url(lang='en', shop='RU', refresh=False):
     """
-     Adds the date to the time (and difference in days to arrival date)
-     Converts all prices to float
-     Deleting the difference in days
-     return flights = [[[departure datetime, arrival datetime, duration, [price1, price2,...]],...][...]]
+    Function return (url of search results, True if url was taken from cache).
+    Url is the redirect target of vacancy.php, it is kept for HTTP['search_url_ttl'] seconds per lang and shop.
+    Use refresh = True to ask vacancy.php again
     """
-    date = [outbound_date, return_date]
-    for table in xrange(0, len(flights)):
-        for index, row in enumerate(flights[table]):
-            flights[table][index][0] = date[table] + ' ' + row[0]
-            if len(row[2]) > 0:
-                new_date = format_date(date[table], 'to_date') + datetime.timedelta(days=int(row[2]))
-                new_date = format_date(new_date, 'to_str')
-                flights[table][index][1] = new_date + ' ' + row[1]
-            else:
-                flights[table][index][1] = date[table] + ' ' + row[1]
-            flights[table][index][3] = row[3].strip()
-            for elem in xrange(4, len(row)):
-                flights[table][index][elem] = float(row[elem].replace(',', ''))
-            del flights[table][index][2]
-    return flights
+    key = (lang, shop)
+    with _http_lock:
+        entry = _http_state['search_urls'].get(key)
+    if not refresh and entry is not None and time.time() - entry[0] < HTTP['search_url_ttl']:
+        return entry[1], True
+    cookie = {'remember': '0%3B' + lang + '0%3B' + shop}
+    with stage('redirect_request'):
+        redirect = site_request('post', 'http://www.flyniki.com/' + lang + '/booking/flight/vacancy.php',
+                                cookies=cookie, allow_redirects=False)
+    search_url = 'http://www.flyniki.com/' + redirect.headers['location']
+    with _http_lock:
+        _http_state['search_urls'][key] = (time.time(), search_url)
+    return search_url, False
 
 
-def get_string_route(search_html, return_date):
+def get_http_session():
     """
-    Get route string. dep. citi(iata) - dest. city(iata) if oneway
-    Else: dep. citi(iata) - dest. city(iata) - dep. citi(iata)
+    Function return shared requests.Session with keep-alive pool (settings from HTTP).
+    Session does not retry, retries are made by site_request
     """
-    route = search_html.xpath('string((//*[@class="vacancy_route"])[1])')
-    route = str(route.encode(sys.getdefaultencoding(), 'replace'))
-    route = route.split(',', 1)[0].strip()
-    route = route.split(' ')
-    route_string = ''
-    for word in route:
-        if word != '?':
-            route_string += word
+    with _http_lock:
+        if _http_state['session'] is None:
+            adapter = requests.adapters.HTTPAdapter(pool_connections=HTTP['pool_connections'],
+                                                    pool_maxsize=HTTP['pool_maxsize'], max_retries=0)
+            session = requests.Session()
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _http_state['session'] = session
+        return _http_state['session']
+
+
+def site_request(method, url, **kwargs):
+    """
+    Function for all requests to the site: shared session, default timeout HTTP['timeout'],
+    rate of each endpoint is limited by rate_bucket, number of simultaneous requests to one host by host_slot.
+    Connection errors, timeouts and RATE_LIMIT['retry_statuses'] are retried RATE_LIMIT['retries'] times
+    after exponential backoff with full jitter (or Retry-After of response).
+    Transport is selected by TRANSPORT['mode']: 'live', 'record' (live and save responses to TRANSPORT['path'])
+    or 'replay' (serve saved responses, flyniki.com is not used)
+    """
+    if TRANSPORT['mode'] == 'replay':
+        response = load_fixture(method, url, kwargs.get('params'), kwargs.get('data'))
+        count('requests')
+        count('bytes_received', len(response.content))
+        return response
+    kwargs.setdefault('timeout', HTTP['timeout'])
+    bucket = rate_bucket(url)
+    limiter = host_slot(urlparse.urlparse(url).netloc)
+    for attempt in xrange(RATE_LIMIT['retries'] + 1):
+        if bucket is not None:
+            count('throttled_seconds', bucket.acquire())
+        limiter.acquire()
+        start = time.time()
+        success = False
+        try:
+            response = get_http_session().request(method, url, **kwargs)
+            retry = response.status_code in RATE_LIMIT['retry_statuses']
+            success = not retry and time.time() - start < RATE_LIMIT['slow']
+        except (requests.ConnectionError, requests.Timeout):
+            count('request_errors')
+            if attempt == RATE_LIMIT['retries']:
+                raise
+            retry_after = None
         else:
-            route_string += ' - '
-    if return_date != 'oneway':
-        route_string = route_string + ' - ' + route_string.split(' - ')[0]
-    return route_string.upper()
+            if not retry or attempt == RATE_LIMIT['retries']:
+                break
+            count('request_errors')
+            retry_after = response.headers.get('Retry-After')
+        finally:
+            limiter.release(success)
+        count('request_retries')
+        delay = random.uniform(0, min(RATE_LIMIT['max_backoff'], RATE_LIMIT['backoff'] * 2 ** attempt))
+        if retry_after and retry_after.isdigit():
+            delay = min(RATE_LIMIT['max_backoff'], max(delay, int(retry_after)))
+        time.sleep(delay)
+    count('requests')
+    count('bytes_received', len(response.content))
+    if TRANSPORT['mode'] == 'record':
+        save_fixture(method, url, kwargs.get('params'), kwargs.get('data'), response.status_code,
+                     response.headers, response.content)
+    return response
 
 
-def get_currency_and_tax(search_data):
+def fixture_path(method, url, params=None, data=None):
     """
-    return currency in () and tax
+    Function return path of fixture file for request. Query string of url (session id of vacancy.php)
+    and cookies do not matter, params and data do not depend on order
     """
-    price_overview_html = lxml.html.fromstring(search_data['templates']['priceoverview'])
-    tax_string = price_overview_html.xpath('//*[@class="additionals-tsc"]/td[2]/text()')[0]
-    tax_string = tax_string.strip().split(' ')
-    currency = tax_string[0].encode(sys.getdefaultencoding(), 'replace')
-    currency = '(' + currency + ')'
-    tax = float(tax_string[1].replace(',', ''))
-    return currency, tax
+    key = json.dumps([method.upper(), url.split('?', 1)[0], sorted((params or {}).items()),
+                      sorted(data.items() if isinstance(data, dict) else (data or []))])
+    return os.path.join(TRANSPORT['path'], hashlib.sha1(key).hexdigest() + '.json')
 
 
-def check_combinability(search_html):
+def save_fixture(method, url, params, data, status, headers, body):
     """
-    Function to check the possibility of cobmining different cabin class. The only way that i have found
+    Function to save response for replay
     """
-    if len(search_html.xpath('//*[@value="COMF"]')) > 0:
-        return False
-    return True
+    if not os.path.isdir(TRANSPORT['path']):
+        os.makedirs(TRANSPORT['path'])
+    fixture = {'method': method.upper(), 'url': url, 'params': params, 'data': data, 'status': status,
+               'headers': dict((key, headers[key]) for key in ('location', 'content-type') if key in headers),
+               'body': body.decode('utf-8', 'replace')}
+    with open(fixture_path(method, url, params, data), 'w') as fixture_file:
+        json.dump(fixture, fixture_file)
 
 
-def print_oneway_result(flights, fares, currency, tax, route):
+def load_fixture(method, url, params, data):
     """
-    Print oneway result sorted by a time of departure
+    Function return saved response as requests.Response, raise requests.ConnectionError if it was not recorded
     """
-    print('\n' + route + '\n')
-    print('{0: ^20}{1: ^20}{2: ^15}{3: ^12}{4: ^20}{5: ^25}'.format('Departure time', 'Arrival time', 'Duration',
-                                                                    '  Price' + currency, 'Cabin class',
-                                                                    'Total price with tax' + currency)+'\n')
-    for row in sorted(flights[0], key=lambda x: x[0]):
-        line = '{0: ^20}{1: ^20}{2: ^15}'.format(row[0], row[1], row[2])
-        for price_index in xrange(3, 3+len(fares[0])):
-            if row[price_index] == 0:
-                continue
-            line = line + '{: >12,.2f}'.format(row[price_index]).replace(',', ' ') + \
-                          '  {: ^18}'.format(fares[0][price_index-3]) + \
-                          '{: >15,.2f}'.format(row[price_index]+tax).replace(',', ' ')
-            line = '{: >87}'.format(line)
-            print(line)
-            line = '{: >55}'.format('')
-        print('{:-^112}'.format(''))
+    path = fixture_path(method, url, params, data)
+    try:
+        with open(path) as fixture_file:
+            fixture = json.load(fixture_file)
+    except (IOError, OSError):
+        raise requests.ConnectionError('No recorded response for %s %s (%s)' % (method.upper(), url, path))
+    response = requests.Response()
+    response.status_code = fixture['status']
+    response.headers.update(fixture['headers'])
+    response.url = url
+    response.encoding = 'utf-8'
+    response._content = fixture['body'].encode('utf-8')
+    return response
 
 
-def print_mix_result(flights, fares, currency, tax, route, mix_fare):
+def host_slot(host):
     """
-    Print mix result sorted by a total amount. First, we create a list of possible options.
-    Check the following parametres:
-    1)Arrival datetime of outbound at least an 1 hour > than the departure datetime of return.
-    2)outbound price !=0 (notbookable price)
-    3)return price !=0
-    4)we can mix the cabin classes or they are the same
-    If all ok we append result to mix_flights - list of:
-    [outbound departure datetime, outbound arrival datetime, outbound duration, outbound price, outbound cabin class,
-    return departure datetime, return arrival datetime, return duration, return price, return cabin class,
-    total price, total price with tax]
+    Function return AdaptiveLimiter of simultaneous requests to the host (at most BATCH['per_host'])
     """
-    print('\n' + route + '\n')
-    mix_flights = []
-    for out_row in flights[0]:
-        for ret_row in flights[1]:
-            if (format_date(out_row[1], 'to_datetime') + datetime.timedelta(hours=1)) > \
-                    format_date(ret_row[0], 'to_datetime'):
-                continue
-            for out_price_index in xrange(3, 3+len(fares[0])):
-                out_price = out_row[out_price_index]
-                for ret_price_index in xrange(3, 3+len(fares[1])):
-                    ret_price = ret_row[ret_price_index]
-                    if (out_price == 0) or (ret_price == 0):
-                        continue
-                    out_fare = fares[0][out_price_index-3]
-                    ret_fare = fares[1][ret_price_index-3]
-                    if (not mix_fare) and (out_fare != ret_fare):
-                        continue
-                    total_price = out_price + ret_price
-                    full_price = total_price + tax
-                    mix_flights.append([out_row[0], out_row[1], out_row[2], out_price, out_fare,
-                                        ret_row[0], ret_row[1], ret_row[2], ret_price, ret_fare,
-                                        total_price, full_price])
-    if len(mix_flights) == 0:
-        raise SearchError('\nNo connections found for the entered data.')
-    print('%s flight options\n' % len(mix_flights))
-    print('{0: ^15}{1: ^20}{2: ^20}{3: ^15}{4: ^12}{5: ^20}{6: ^20}{7: ^25}'.
-          format('Direction', 'Departure time', 'Arrival time', 'Duration',
-                 '  Price' + currency, 'Cabin class', 'Total price' + currency,
-                 'Total price with tax' + currency) + '\n')
-    for elem in sorted(mix_flights, key=lambda x: x[11]):
-        print('{0: ^15}{1: ^20}{2: ^20}{3: ^15}'.format('outbound', elem[0], elem[1], elem[2]) +
-              '{: >12,.2f}'.format(elem[3]).replace(',', ' ') + '{: ^20}'.format(elem[4]))
-        print('{: >100}'.format('') + '{: >15,.2f}'.format(elem[10]).replace(',', ' ') +
-              '{: >20,.2f}'.format(elem[11]).replace(',', ' '))
-        print('{0: ^15}{1: ^20}{2: ^20}{3: ^15}'.format('return', elem[5], elem[6], elem[7]) +
-              '{: >12,.2f}'.format(elem[8]).replace(',', ' ') + '{: ^20}'.format(elem[9]))
-        print('{:-^142}'.format(''))
+    with _host_slots_lock:
+        if host not in _host_slots:
+            _host_slots[host] = AdaptiveLimiter(BATCH['per_host'])
+        return _host_slots[host]
 
 
-def flyniki_search(search_parameters):
+def rate_bucket(url):
     """
-    Main function
+    Function return shared TokenBucket of url endpoint (RATE_LIMIT['endpoints'] by file name of url path)
+    with budget RATE_LIMIT['budgets'] (requests per second, burst), or None for endpoint without budget
     """
-    search_parameters = search_parameters[1:] if (len(search_parameters) > 1) else []
-    while True:
-        try:
-            dep_iata, dest_iata, outbound_date, return_date = check_search_parameters(search_parameters)
-            search_data = get_search_data(dep_iata, dest_iata, outbound_date, return_date).json()
-            check_for_result_errors(search_data)
-            search_html = lxml.html.fromstring(search_data['templates']['main'])
-            fares, flights = data_processing(search_html, return_date)
-            flights = format_result(flights, outbound_date, return_date)
-            currency, tax = get_currency_and_tax(search_data)
+    endpoint = RATE_LIMIT['endpoints'].get(urlparse.urlparse(url).path.rsplit('/', 1)[-1])
+    budget = RATE_LIMIT['budgets'].get(endpoint)
+    if not budget or not budget[0]:
+        return None
+    with _rate_buckets_lock:
+        if endpoint not in _rate_buckets:
+            _rate_buckets[endpoint] = TokenBucket(*budget)
+        return _rate_buckets[endpoint]
+
+
+def parse_rate_budgets(value):
+    """
+    Function return dict {endpoint: (requests per second, burst)} from option value
+    'endpoint:rate[/burst],...', e.g. 'search:2/4,suggest:5'. Default burst is 2 * rate, rate 0 - no limit
+    """
+    budgets = {}
+    for budget in value.split(','):
+        endpoint, _, rate = budget.partition(':')
+        rate, _, burst = rate.partition('/')
+        try:
+            rate = float(rate)
+            burst = int(burst) if burst else max(1, int(2 * rate))
+        except ValueError:
+            raise ParametersError('\nWrong rate budget %s, use endpoint:rate[/burst]' % budget)
+        if rate < 0 or burst < 1:
+            raise ParametersError('\nWrong rate budget %s, rate must be at least 0 and burst at least 1' % budget)
+        if endpoint not in RATE_LIMIT['budgets']:
+            raise ParametersError('\nUnknown endpoint %s, use one of: %s'
+                                  % (endpoint, ', '.join(sorted(RATE_LIMIT['budgets']))))
+        budgets[endpoint] = (rate, burst)
+    return budgets
+
+
+def stage(name):
+    """
+    Function return context manager measuring time of stage name, it does nothing if STATS['enabled'] is False
+    """
+    if not STATS['enabled']:
+        return NO_STAGE
+    return Stage(name)
+
+
+def record_time(name, seconds):
+    """
+    Function to add time of stage to stats: number of calls, total and max seconds
+    """
+    with _stats_lock:
+        timer = _stats['timers'].setdefault(name, [0, 0.0, 0.0])
+        timer[0] += 1
+        timer[1] += seconds
+        timer[2] = max(timer[2], seconds)
+        hooks = list(_stats['hooks'])
+    for hook in hooks:
+        hook('timer', name, seconds)
+
+
+def count(name, value=1):
+    """
+    Function to add value to counter name, it does nothing if STATS['enabled'] is False
+    """
+    if not STATS['enabled']:
+        return
+    with _stats_lock:
+        _stats['counters'][name] = _stats['counters'].get(name, 0) + value
+        hooks = list(_stats['hooks'])
+    for hook in hooks:
+        hook('counter', name, value)
+
+
+def add_stats_hook(hook):
+    """
+    Function to register callback hook(kind, name, value), kind is 'timer' (value - seconds of one stage call)
+    or 'counter' (value - increment). Registering a hook enables stats
+    """
+    with _stats_lock:
+        _stats['hooks'].append(hook)
+    STATS['enabled'] = True
+
+
+def get_stats():
+    """
+    Function return dict of stats: timers {stage: {calls, seconds, max_seconds}}, counters {name: value}
+    (including result cache counters) and cache hit rates
+    """
+    with _stats_lock:
+        timers = dict((name, {'calls': timer[0], 'seconds': timer[1], 'max_seconds': timer[2]})
+                      for name, timer in _stats['timers'].items())
+        counters = dict(_stats['counters'])
+    for name, value in result_cache_stats().items():
+        counters['result_cache_' + name] = value
+    hit_rates = {}
+    for cache in ('airport_cache', 'result_cache'):
+        hits = counters.get(cache + '_hits', 0)
+        lookups = hits + counters.get(cache + '_misses', 0) + counters.get(cache + '_coalesced', 0)
+        if lookups:
+            hit_rates[cache] = float(hits) / lookups
+    return {'timers': timers, 'counters': counters, 'hit_rates': hit_rates}
+
+
+def reset_stats():
+    """
+    Function to clear timers and counters (hooks are kept)
+    """
+    with _stats_lock:
+        _stats['timers'].clear()
+        _stats['counters'].clear()
+
+
+def format_stats(stats=None):
+    """
+    Function return stats as text table for --profile
+    """
+    stats = stats or get_stats()
+    lines = ['{0: <22}{1: >10}{2: >14}{3: >14}{4: >14}'.format('Stage', 'Calls', 'Total, s', 'Mean, ms', 'Max, ms')]
+    for name, timer in sorted(stats['timers'].items(), key=lambda (k, v): -v['seconds']):
+        lines.append('{0: <22}{1: >10}{2: >14.4f}{3: >14.2f}{4: >14.2f}'.format(
+            name, timer['calls'], timer['seconds'], 1000 * timer['seconds'] / timer['calls'],
+            1000 * timer['max_seconds']))
+    for name, value in sorted(stats['counters'].items()):
+        lines.append('{0: <22}{1: >10}'.format(name, value))
+    for name, rate in sorted(stats['hit_rates'].items()):
+        lines.append('{0: <22}{1: >10.1%}'.format(name + '_hit_rate', rate))
+    return '\n'.join(lines)
+
+
+def format_stats_prometheus(stats=None):
+    """
+    Function return stats in Prometheus text exposition format
+    """
+    stats = stats or get_stats()
+    lines = ['# TYPE flyniki_stage_seconds_total counter']
+    for name, timer in sorted(stats['timers'].items()):
+        lines.append('flyniki_stage_seconds_total{stage="%s"} %f' % (name, timer['seconds']))
+    lines.append('# TYPE flyniki_stage_calls_total counter')
+    for name, timer in sorted(stats['timers'].items()):
+        lines.append('flyniki_stage_calls_total{stage="%s"} %d' % (name, timer['calls']))
+    for name, value in sorted(stats['counters'].items()):
+        lines.append('# TYPE flyniki_%s %s' % (name, 'gauge' if name.endswith('_size') else 'counter'))
+        lines.append('flyniki_%s %s' % (name, value))
+    lines.append('# TYPE flyniki_cache_hit_ratio gauge')
+    for name, rate in sorted(stats['hit_rates'].items()):
+        lines.append('flyniki_cache_hit_ratio{cache="%s"} %f' % (name, rate))
+    return '\n'.join(lines) + '\n'
+
+
+def dump_stats(path=None):
+    """
+    Function to write stats to file (STATS['dump_path'] by default): JSON if path ends with .json,
+    else Prometheus text. File is replaced atomically, so it can be read by collector at any time
+    """
+    path = path or STATS['dump_path']
+    if not path:
+        return
+    stats = get_stats()
+    with open(path + '.tmp', 'w') as stats_file:
+        if path.endswith('.json'):
+            json.dump(stats, stats_file, indent=2, sort_keys=True)
+        else:
+            stats_file.write(format_stats_prometheus(stats))
+    os.rename(path + '.tmp', path)
+
+
+def check_for_result_errors(search_data):
+    """
+    Function to checking data for errors and result availability
+    """
+    if 'error' in search_data:
+        err_msg = lxml.html.fromstring(search_data['error']).xpath('string(//*[@class = "wrapper"])')
+        raise SearchError('\n' + err_msg.encode(sys.getdefaultencoding(), 'replace'))
+    if 'No connections' in search_data['templates']['dateoverview']:
+        raise NoConnectionsError('\nNo connections found for the entered data. '
+                                 'However, connections are available on days either side. Keep searching!')
+
+
+def parse_date_overview(search_data):
+    """
+    Function return prices from dateoverview template: {date DD.MM.YY: lowest price}.
+    Day cells are found by their date value (attribute data-date or value of radio input) in YYYY-MM-DD format,
+    price is the first number with 2 decimals in the text of the cell (td, li or label around the date).
+    Days without price or without cell are skipped, if template is absent - return {}
+    """
+    template = search_data.get('templates', {}).get('dateoverview')
+    if not template or not template.strip():
+        return {}
+    prices = {}
+    for elem in OVERVIEW_DATES_XPATH(lxml.html.fromstring(template)):
+        value = elem.get('data-date') or elem.get('value')
+        if not re.match(r'\d{4}-\d{2}-\d{2}$', value):
+            continue
+        cell = elem if elem.tag in ('td', 'li', 'label') else next(elem.iterancestors('td', 'li', 'label'), None)
+        if cell is None:
+            continue
+        price = re.search(r'\d[\d,]*\.\d{2}', cell.text_content())
+        if price is None:
+            continue
+        date = format_date(datetime.datetime.strptime(value, '%Y-%m-%d').date(), 'to_str')
+        prices.setdefault(date, float(price.group().replace(',', '')))
+    return prices
+
+
+def data_processing(search_html, return_date):
+    """
+    The gathering of information on flights from the received data. flights = [outbound table, return table].
+    Each table list of tuples: (departure time, arrival time, difference in days, duration, [price1, price2,...]).
+    Difference in days is int (0 if arrival at the same day), prices are float.
+    Price is selected from two possible (current and lowest), defaults to the current, but sometimes it does not exist.
+    If price 'notbookable' - price = 0
+    fare_types = [[outbound fare types][return fare types]]. Each table list of used cabin classes.
+    Each flight table is walked once, cells of a row are read by precompiled XPath queries.
+    """
+    flight_tables = 1 if return_date == 'oneway' else 2
+    fare_types = [[intern_fare(fare) for fare in FARE_NAMES_XPATH(elem)]
+                  for elem in FARE_TYPES_XPATH(search_html)[:flight_tables]]
+    fare_types += [[] for _ in xrange(flight_tables - len(fare_types))]
+    flights = []
+    for table, flight_table in enumerate(FLIGHT_TABLES_XPATH(search_html)[:flight_tables]):
+        flights.append([parse_flight_row(row, len(fare_types[table])) for row in FLIGHT_ROWS_XPATH(flight_table)])
+    flights += [[] for _ in xrange(flight_tables - len(flights))]
+    return fare_types, flights
+
+
+def parse_flight_row(row, fares_count):
+    """
+    Parse one flightrow with precompiled XPath queries on its cells:
+    (departure time, arrival time, difference in days, duration, [price1, price2,...])
+    """
+    cells = ROW_CELLS_XPATH(row)
+    prices = []
+    for cell in cells[4:4+fares_count]:
+        if SPAN_XPATH(cell):
+            prices.append(0.0)
+        else:
+            prices.append(float((PRICE_XPATH(cell) or LOW_PRICE_XPATH(cell)).replace(',', '')))
+    days = DAYS_XPATH(cells[1])
+    return (str(DEPARTURE_TIME_XPATH(cells[1])), str(ARRIVAL_TIME_XPATH(cells[1])), int(days) if days else 0,
+            str(SPAN_XPATH(cells[3]).strip()), prices)
+
+
+def format_result(flights, outbound_date, return_date):
+    """
+     Makes Flight records: adds the date to the time (and difference in days to arrival date)
+     return flights = [[Flight, Flight,...], [...]]
+    """
+    date = [outbound_date, return_date]
+    result = []
+    for table in xrange(0, len(flights)):
+        result.append([])
+        table_date = format_date(date[table], 'to_date')
+        for departure_time, arrival_time, days, duration, prices in flights[table]:
+            departure = combine_date_and_time(table_date, departure_time)
+            arrival = combine_date_and_time(table_date + datetime.timedelta(days=days), arrival_time)
+            result[table].append(Flight(departure, arrival, duration, prices))
+    return result
+
+
+def combine_date_and_time(date, time_string):
+    """
+    Function return datetime from date and time string HH:MM
+    """
+    hours, minutes = time_string.split(':')
+    return datetime.datetime(date.year, date.month, date.day, int(hours), int(minutes))
+
+
+def get_page_info(search_data, return_date):
+    """
+    Function return (route, mix_fare, currency, tax) of search data in one pass over each of
+    templates main and priceoverview (see format_route, parse_tax).
+    Different cabin classes can not be combined if main has COMF fare
+    """
+    route = ''
+    mix_fare = True
+    for elem in PAGE_INFO_XPATH(get_template_tree(search_data, 'main')):
+        if elem.get('class') == 'vacancy_route':
+            route = elem.text_content()
+        else:
+            mix_fare = False
+    currency, tax = parse_tax(TAX_XPATH(get_template_tree(search_data, 'priceoverview'))[0])
+    return format_route(route, return_date), return_date != 'oneway' and mix_fare, currency, tax
+
+
+def format_route(route, return_date):
+    """
+    Format text of vacancy_route: dep. citi(iata) - dest. city(iata) if oneway
+    Else: dep. citi(iata) - dest. city(iata) - dep. citi(iata)
+    """
+    route = str(route.encode(sys.getdefaultencoding(), 'replace'))
+    route = route.split(',', 1)[0].strip()
+    route = route.split(' ')
+    route_string = ''
+    for word in route:
+        if word != '?':
+            route_string += word
+        else:
+            route_string += ' - '
+    if return_date != 'oneway':
+        route_string = route_string + ' - ' + route_string.split(' - ')[0]
+    return route_string.upper()
+
+
+def get_currency_and_tax(search_data):
+    """
+    return currency in () and tax
+    """
+    return parse_tax(TAX_XPATH(get_template_tree(search_data, 'priceoverview'))[0])
+
+
+def parse_tax(tax_string):
+    """
+    return currency in () and tax from text of tax cell of priceoverview
+    """
+    tax_string = tax_string.strip().split(' ')
+    currency = tax_string[0].encode(sys.getdefaultencoding(), 'replace')
+    currency = '(' + currency + ')'
+    tax = float(tax_string[1].replace(',', ''))
+    return currency, tax
+
+
+def print_oneway_result(flights, fares, currency, tax, route):
+    """
+    Print oneway result sorted by a time of departure
+    """
+    print('\n' + route + '\n')
+    print('{0: ^20}{1: ^20}{2: ^15}{3: ^12}{4: ^20}{5: ^25}'.format('Departure time', 'Arrival time', 'Duration',
+                                                                    '  Price' + currency, 'Cabin class',
+                                                                    'Total price with tax' + currency)+'\n')
+    for flight in sorted(flights[0], key=lambda x: x.departure):
+        line = '{0: ^20}{1: ^20}{2: ^15}'.format(format_date(flight.departure, 'from_datetime'),
+                                                 format_date(flight.arrival, 'from_datetime'), flight.duration)
+        for fare, price in zip(fares[0], flight.prices):
+            if price == 0:
+                continue
+            line = line + '{: >12,.2f}'.format(price).replace(',', ' ') + \
+                          '  {: ^18}'.format(fare) + \
+                          '{: >15,.2f}'.format(price+tax).replace(',', ' ')
+            line = '{: >87}'.format(line)
+            print(line)
+            line = '{: >55}'.format('')
+        print('{:-^112}'.format(''))
+
+
+def combine_flights(flights, fares, tax, mix_fare):
+    """
+    Generator of round trip options sorted by a total amount, the full cross product is never built.
+    Check the following parametres:
+    1)Arrival datetime of outbound at least MIN_CONNECTION_TIME earlier than the departure datetime of return.
+    2)outbound price !=0 (notbookable price)
+    3)return price !=0
+    4)we can mix the cabin classes (then only the cheapest cabin class of each flight is used)
+    or they are the same
+    Returns of each outbound are taken in order of price, so each outbound gives sorted stream of options,
+    streams are merged by heap. Yields lists of:
+    [outbound Flight, outbound price, outbound cabin class, return Flight, return price, return cabin class,
+    total price, total price with tax]
+    """
+    streams = []
+    for out_legs, ret_legs in fare_groups(flights, fares, mix_fare):
+        ret_legs.sort()
+        ret_departures = sorted(leg[2].departure for leg in ret_legs)
+        for out_leg in out_legs:
+            earliest_return = out_leg[2].arrival + MIN_CONNECTION_TIME
+            if bisect.bisect_left(ret_departures, earliest_return) < len(ret_departures):
+                streams.append(combinations_of_outbound(out_leg, ret_legs, earliest_return, tax))
+    options = 0
+    try:
+        for option in heapq.merge(*streams):
+            options += 1
+            yield option[-1]
+    finally:
+        count('combinations', options)
+
+
+def fare_groups(flights, fares, mix_fare):
+    """
+    Function return list of (outbound legs, return legs) which can be combined with each other.
+    Leg is (price, index, Flight, cabin class). If mix_fare - one group with the cheapest bookable cabin class
+    of each flight, else one group for each cabin class.
+    """
+    legs = [[], []]
+    for table in xrange(0, 2):
+        for index, flight in enumerate(flights[table]):
+            bookable = [(price, fare) for fare, price in zip(fares[table], flight.prices) if price != 0]
+            if mix_fare and bookable:
+                price, fare = min(bookable)
+                legs[table].append((price, index, flight, fare))
+            else:
+                legs[table].extend((price, index, flight, fare) for price, fare in bookable)
+    if mix_fare:
+        return [tuple(legs)]
+    groups = []
+    for fare in sorted(set(fares[0]) & set(fares[1])):
+        groups.append(([leg for leg in legs[0] if leg[3] == fare], [leg for leg in legs[1] if leg[3] == fare]))
+    return groups
+
+
+def combinations_of_outbound(out_leg, ret_legs, earliest_return, tax):
+    """
+    Generator of options for one outbound leg with return legs (sorted by price) departing not earlier
+    than earliest_return. Yields (total price with tax, indexes and cabin class for stable order, option)
+    """
+    out_price, out_index, out_flight, out_fare = out_leg
+    for ret_price, ret_index, ret_flight, ret_fare in ret_legs:
+        if ret_flight.departure < earliest_return:
+            continue
+        total_price = out_price + ret_price
+        yield (total_price + tax, out_index, ret_index, ret_fare,
+               [out_flight, out_price, out_fare, ret_flight, ret_price, ret_fare, total_price, total_price + tax])
+
+
+def count_combinations(flights, fares, mix_fare):
+    """
+    Function return number of options of combine_flights without building them
+    """
+    combinations = 0
+    for out_legs, ret_legs in fare_groups(flights, fares, mix_fare):
+        ret_departures = sorted(leg[2].departure for leg in ret_legs)
+        for out_leg in out_legs:
+            combinations += len(ret_departures) - bisect.bisect_left(ret_departures,
+                                                                     out_leg[2].arrival + MIN_CONNECTION_TIME)
+    return combinations
+
+
+def cheapest_combinations(flights, fares, tax, mix_fare, number):
+    """
+    Function return list of number the cheapest round trip options (as combine_flights)
+    """
+    return list(itertools.islice(combine_flights(flights, fares, tax, mix_fare), number))
+
+
+def print_mix_result(flights, fares, currency, tax, route, mix_fare, limit=None):
+    """
+    Print mix result sorted by a total amount, options are made by combine_flights.
+    Use limit to print only the cheapest options
+    """
+    print('\n' + route + '\n')
+    options = count_combinations(flights, fares, mix_fare)
+    if options == 0:
+        raise SearchError('\nNo connections found for the entered data.')
+    if limit and limit < options:
+        print('%s flight options, the cheapest %s of them:\n' % (options, limit))
+    else:
+        print('%s flight options\n' % options)
+    print('{0: ^15}{1: ^20}{2: ^20}{3: ^15}{4: ^12}{5: ^20}{6: ^20}{7: ^25}'.
+          format('Direction', 'Departure time', 'Arrival time', 'Duration',
+                 '  Price' + currency, 'Cabin class', 'Total price' + currency,
+                 'Total price with tax' + currency) + '\n')
+    with stage('print_mix_result'):
+        print_combinations(itertools.islice(combine_flights(flights, fares, tax, mix_fare), limit))
+
+
+def print_combinations(combinations):
+    """
+    Print round trip options of combine_flights
+    """
+    for elem in combinations:
+        print('{0: ^15}{1: ^20}{2: ^20}{3: ^15}'.format('outbound', format_date(elem[0].departure, 'from_datetime'),
+                                                        format_date(elem[0].arrival, 'from_datetime'),
+                                                        elem[0].duration) +
+              '{: >12,.2f}'.format(elem[1]).replace(',', ' ') + '{: ^20}'.format(elem[2]))
+        print('{: >100}'.format('') + '{: >15,.2f}'.format(elem[6]).replace(',', ' ') +
+              '{: >20,.2f}'.format(elem[7]).replace(',', ' '))
+        print('{0: ^15}{1: ^20}{2: ^20}{3: ^15}'.format('return', format_date(elem[3].departure, 'from_datetime'),
+                                                        format_date(elem[3].arrival, 'from_datetime'),
+                                                        elem[3].duration) +
+              '{: >12,.2f}'.format(elem[4]).replace(',', ' ') + '{: ^20}'.format(elem[5]))
+        print('{:-^142}'.format(''))
+
+
+def search(dep_iata, dest_iata, outbound_date, return_date, lang='en', shop='RU'):
+    """
+    Search on flyniki.com for checked parameters without printing.
+    return dict: route, fares, flights (as format_result), currency, tax, mix_fare
+    Results are cached for RESULT_CACHE['ttl'] seconds, simultaneous searches with the same parameters
+    wait for the first one instead of asking flyniki.com again. Flights of result are shared, do not change them.
+    """
+    key = result_cache_key(dep_iata, dest_iata, outbound_date, return_date, lang, shop)
+    with _result_cache_lock:
+        entry = _result_cache.pop(key, None)
+        if entry is not None and time.time() - entry[0] < RESULT_CACHE['ttl']:
+            _result_cache[key] = entry
+            _result_cache_state['hits'] += 1
+            return dict(entry[1])
+        in_flight = _result_cache_state['in_flight'].get(key)
+        if in_flight is None:
+            in_flight = _result_cache_state['in_flight'][key] = {'done': threading.Event()}
+            _result_cache_state['misses'] += 1
+            leader = True
+        else:
+            _result_cache_state['coalesced'] += 1
+            leader = False
+    if not leader:
+        in_flight['done'].wait()
+        if 'error' in in_flight:
+            raise in_flight['error']
+        return dict(in_flight['result'])
+    try:
+        search_data = get_search_data(dep_iata, dest_iata, outbound_date, return_date, lang, shop).json()
+        in_flight['result'] = parse_search_data(search_data, dep_iata, dest_iata, outbound_date, return_date)
+    except Exception as err:
+        in_flight['error'] = err
+        raise
+    finally:
+        with _result_cache_lock:
+            del _result_cache_state['in_flight'][key]
+            if 'result' in in_flight and RESULT_CACHE['ttl'] > 0:
+                _result_cache[key] = (time.time(), in_flight['result'])
+                while len(_result_cache) > RESULT_CACHE['max_entries']:
+                    _result_cache.popitem(last=False)
+        in_flight['done'].set()
+    return dict(in_flight['result'])
+
+
+def result_cache_key(dep_iata, dest_iata, outbound_date, return_date, lang, shop):
+    """
+    Function return key of result cache: IATA codes in upper case, dates as datetime.date, lang and shop
+    """
+    outbound_date = format_date(outbound_date, 'to_date')
+    if return_date != 'oneway':
+        return_date = format_date(return_date, 'to_date')
+    return dep_iata.upper(), dest_iata.upper(), outbound_date, return_date, lang.lower(), shop.upper()
+
+
+def result_cache_stats():
+    """
+    Function return dict of result cache counters: hits, misses, coalesced (waited for the same search) and size
+    """
+    with _result_cache_lock:
+        return {'hits': _result_cache_state['hits'],
+                'misses': _result_cache_state['misses'],
+                'coalesced': _result_cache_state['coalesced'],
+                'size': len(_result_cache)}
+
+
+def parse_search_data(search_data, dep_iata, dest_iata, outbound_date, return_date):
+    """
+    Check received search data for errors and parse it. return dict as search()
+    Result is appended to fare history if HISTORY['enabled'] (see record_history)
+    """
+    check_for_result_errors(search_data)
+    search_html = get_template_tree(search_data, 'main')
+    with stage('data_processing'):
+        fares, flights = data_processing(search_html, return_date)
+    with stage('format_result'):
+        flights = format_result(flights, outbound_date, return_date)
+    count('rows', sum(len(table) for table in flights))
+    with stage('page_info'):
+        route, mix_fare, currency, tax = get_page_info(search_data, return_date)
+    result = {'route': route,
+              'fares': fares,
+              'flights': flights,
+              'currency': currency,
+              'tax': tax,
+              'mix_fare': mix_fare}
+    if HISTORY['enabled']:
+        with stage('history'):
+            record_history(dep_iata, dest_iata, outbound_date, return_date, result)
+    return result
+
+
+def print_result(result, return_date, limit=None):
+    """
+    Print result of search() oneway or mixed. Use limit to print only the cheapest mixed options
+    """
+    if return_date == 'oneway':
+        print_oneway_result(result['flights'], result['fares'], result['currency'], result['tax'], result['route'])
+    else:
+        print_mix_result(result['flights'], result['fares'], result['currency'], result['tax'], result['route'],
+                         result['mix_fare'], limit)
+
+
+def iter_records(result, return_date, limit=None):
+    """
+    Generator of flat records (dicts with RECORD_FIELDS) of search() result, nothing is formatted.
+    Oneway: one record for each bookable cabin class of each flight, sorted by a time of departure,
+    return_* fields are None. Round trip: options of combine_flights sorted by a total amount (limit - number
+    of the cheapest options). Datetimes are datetime.datetime, prices are float, tax is added to total only.
+    """
+    route = result['route']
+    currency = result['currency'].strip('()')
+    tax = result['tax']
+    if return_date == 'oneway':
+        records = 0
+        for flight in sorted(result['flights'][0], key=lambda x: x.departure):
+            for fare, price in zip(result['fares'][0], flight.prices):
+                if price == 0:
+                    continue
+                if limit is not None and records >= limit:
+                    return
+                records += 1
+                yield {'route': route, 'outbound_departure': flight.departure, 'outbound_arrival': flight.arrival,
+                       'outbound_duration': flight.duration, 'outbound_fare': fare, 'outbound_price': price,
+                       'return_departure': None, 'return_arrival': None, 'return_duration': None,
+                       'return_fare': None, 'return_price': None, 'total_price': price,
+                       'total_price_with_tax': price + tax, 'currency': currency}
+        return
+    options = combine_flights(result['flights'], result['fares'], tax, result['mix_fare'])
+    for out_flight, out_price, out_fare, ret_flight, ret_price, ret_fare, total, full in \
+            itertools.islice(options, limit):
+        yield {'route': route, 'outbound_departure': out_flight.departure, 'outbound_arrival': out_flight.arrival,
+               'outbound_duration': out_flight.duration, 'outbound_fare': out_fare, 'outbound_price': out_price,
+               'return_departure': ret_flight.departure, 'return_arrival': ret_flight.arrival,
+               'return_duration': ret_flight.duration, 'return_fare': ret_fare, 'return_price': ret_price,
+               'total_price': total, 'total_price_with_tax': full, 'currency': currency}
+
+
+def record_values(record):
+    """
+    Function return list of record values in order of RECORD_FIELDS: datetimes in ISO format, None as ''
+    """
+    values = []
+    for field in RECORD_FIELDS:
+        value = record.get(field)
+        if value is None:
+            value = ''
+        elif isinstance(value, datetime.datetime):
+            value = value.isoformat()
+        values.append(value)
+    return values
+
+
+def write_records(records, output_format, stream=None, header=True):
+    """
+    Write records one by one to stream (stdout by default) in 'jsonl' or 'csv' format (with header if header = True).
+    return number of written records
+    """
+    stream = stream or sys.stdout
+    written = 0
+    if output_format == 'csv':
+        writer = csv.writer(stream)
+        if header:
+            writer.writerow(RECORD_FIELDS)
+        for record in records:
+            writer.writerow([value.encode('utf-8') if isinstance(value, unicode) else value
+                             for value in record_values(record)])
+            written += 1
+    elif output_format == 'jsonl':
+        for record in records:
+            stream.write(json.dumps(dict(zip(RECORD_FIELDS, record_values(record)))) + '\n')
+            written += 1
+    else:
+        raise ParametersError('\nUnknown output format %s, use one of: %s' % (output_format,
+                                                                              ', '.join(OUTPUT_FORMATS)))
+    stream.flush()
+    return written
+
+
+def write_result(result, return_date, output_format='text', limit=None, stream=None):
+    """
+    Output search() result: 'text' is printed by print_result, 'jsonl' and 'csv' are written by write_records
+    """
+    with stage('write_result'):
+        if output_format == 'text':
+            print_result(result, return_date, limit)
+        else:
+            write_records(iter_records(result, return_date, limit), output_format, stream)
+
+
+def parse_options(args):
+    """
+    Split command line arguments to positional arguments and options --name=value (or --name for flags).
+    Values of NUMERIC_OPTIONS are converted to numbers, wrong value raise ParametersError.
+    return (list of positional arguments, dict of options)
+    """
+    positional = []
+    options = {}
+    for arg in args:
+        if arg.startswith('--') and len(arg) > 2:
+            name, _, value = arg[2:].partition('=')
+            options[name] = value if value else True
+            if name in NUMERIC_OPTIONS:
+                options[name] = parse_number_option(name, options[name])
+        else:
+            positional.append(arg)
+    return positional, options
+
+
+def parse_number_option(name, value):
+    """
+    Function return value of numeric option name converted by type of NUMERIC_OPTIONS, not less than its minimum
+    """
+    number_type, minimum = NUMERIC_OPTIONS[name]
+    try:
+        number = number_type(value) if value is not True else None
+    except ValueError:
+        number = None
+    if number is None or number < minimum:
+        raise ParametersError('\n--%s must be %s not less than %s' % (
+            name, 'integer' if number_type is int else 'number', minimum))
+    return number
+
+
+def result_to_dict(result):
+    """
+    Function return copy of search() result (or run_query record) with Flight records converted to dicts
+    """
+    result = dict(result)
+    if 'flights' in result:
+        result['flights'] = [[flight.as_dict(fares) for flight in table]
+                             for table, fares in zip(result['flights'], result['fares'])]
+    return result
+
+
+def read_queries(stream):
+    """
+    Generator of search queries (lists of parameters) from CSV or JSON Lines stream.
+    JSON line is a list of parameters or object with keys dep_iata, dest_iata, outbound_date, return_date.
+    Empty lines, lines starting with # and CSV header are skipped.
+    Line which can not be read as query is yielded as error record {'query': [line], 'error': message}
+    """
+    for line in stream:
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        try:
+            if line[0] in '[{':
+                query = json.loads(line)
+                if isinstance(query, dict):
+                    query = [query.get(key, '') for key in ('dep_iata', 'dest_iata', 'outbound_date',
+                                                            'return_date')]
+            else:
+                query = next(csv.reader([line]))
+                if query[0].strip().lower() in ('dep_iata', 'departure'):
+                    continue
+        except (ValueError, csv.Error):
+            yield {'query': [line], 'error': 'Wrong query line, use CSV or JSON Lines'}
+            continue
+        if not isinstance(query, list) or not all(isinstance(elem, basestring) for elem in query if elem):
+            yield {'query': [line], 'error': 'Parameters of query must be strings'}
+            continue
+        yield [elem for elem in query if elem]
+
+
+def run_query(query):
+    """
+    Validate and run one query in non-interactive mode.
+    return dict of result with the query, or with the error message (error record of read_queries as is)
+    """
+    if isinstance(query, dict):
+        return query
+    record = {'query': query}
+    try:
+        dep_iata, dest_iata, outbound_date, return_date = validate_query(query)
+        record.update(search(dep_iata, dest_iata, outbound_date, return_date))
+    except search_errors() as err:
+        record['error'] = error_message(err)[0]
+    return record
+
+
+def batch_search(queries, workers=None):
+    """
+    Generator to run queries on pool of threads (BATCH['workers'], requests to one host are limited by
+    BATCH['per_host']). Yields results of run_query as soon as each query finishes, not in order of queries.
+    """
+    for _, record in thread_map(run_query, queries, workers):
+        yield record
+
+
+def thread_map(function, items, workers=None):
+    """
+    Generator to call function for each of items on pool of threads (BATCH['workers'] by default).
+    Yields (item, result) as soon as each call finishes. Exception of function or of items iterator
+    is raised in the caller thread.
+    """
+    workers = workers or BATCH['workers']
+    tasks = Queue.Queue(maxsize=workers * 2)
+    results = Queue.Queue()
+
+    def worker():
+        try:
+            while True:
+                task = tasks.get()
+                if task is None:
+                    return
+                try:
+                    results.put((task[0], function(task[0]), None))
+                except Exception:
+                    results.put((task[0], None, sys.exc_info()))
+        finally:
+            results.put(None)
+
+    def feeder():
+        try:
+            for item in items:
+                tasks.put((item,))
+        except Exception:
+            results.put((None, None, sys.exc_info()))
+        finally:
+            for _ in xrange(workers):
+                tasks.put(None)
+
+    threads = [threading.Thread(target=feeder)] + [threading.Thread(target=worker) for _ in xrange(workers)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    finished = 0
+    while finished < workers:
+        result = results.get()
+        if result is None:
+            finished += 1
+        elif result[2] is not None:
+            raise result[2][0], result[2][1], result[2][2]
+        else:
+            yield result[:2]
+
+
+def batch_main(args, options):
+    """
+    Batch mode: -batch [file|-] [--workers=N] [--per-host=N] [--format=jsonl|csv]
+    Read queries from the file (stdin by default) and write one JSON line per finished query to stdout.
+    With --format=jsonl or csv, flat records of all queries are written instead (see iter_records),
+    errors go to stderr.
+    """
+    workers = options.get('workers', BATCH['workers'])
+    output_format = options.get('format')
+    header = True
+    stream = sys.stdin if (not args or args[0] == '-') else open(args[0])
+    try:
+        for record in batch_search(read_queries(stream), workers):
+            if output_format in (None, 'text'):
+                sys.stdout.write(json.dumps(result_to_dict(record)) + '\n')
+                sys.stdout.flush()
+            elif 'error' in record:
+                sys.stderr.write('%s: %s\n' % (' '.join(record['query']), record['error']))
+            else:
+                return_date = record['query'][3] if len(record['query']) > 3 else 'oneway'
+                write_records(iter_records(record, return_date), output_format, header=header)
+                header = False
+    finally:
+        if stream is not sys.stdin:
+            stream.close()
+
+
+def calendar_dates(first_date, last_date):
+    """
+    Function return list of dates DD.MM.YY for calendar: from first_date to last_date,
+    or first_date +- N days if last_date is '+-N'. Dates outside of bookable period (check_dates) are skipped
+    """
+    try:
+        first = format_date(first_date, 'to_date')
+    except ValueError:
+        raise ParametersError('Incorrect first date %s. Use DD.MM.YY' % first_date)
+    window = re.match(r'(\+-|\+/-|-\+)?(\d+)$', last_date)
+    if window:
+        days = int(window.group(2))
+        first, last = first - datetime.timedelta(days=days), first + datetime.timedelta(days=days)
+    else:
+        try:
+            last = format_date(last_date, 'to_date')
+        except ValueError:
+            raise ParametersError('Incorrect last date %s. Use DD.MM.YY or +-N' % last_date)
+    if (last - first).days >= CALENDAR['max_days']:
+        raise ParametersError('Too long period, calendar is limited by %d days' % CALENDAR['max_days'])
+    dates = []
+    for day in xrange((last - first).days + 1):
+        date = format_date(first + datetime.timedelta(days=day), 'to_str')
+        if check_dates(date, 'oneway', errors=[])[0]:
+            dates.append(date)
+    if not dates:
+        raise ParametersError('No bookable dates from %s to %s' % (format_date(first, 'to_str'),
+                                                                    format_date(last, 'to_str')))
+    return dates
+
+
+def search_calendar(dep_iata, dest_iata, dates, stay=None, workers=None):
+    """
+    Function to search the lowest price for each of dates (oneway, or round trip with return after stay days).
+    Searches are run on pool of threads. For oneway, dates are searched with step CALENDAR['overview_days'] first,
+    prices of other days are taken from dateoverview template of these searches, the rest days are searched then.
+    return dict: route, currency, tax, days - OrderedDict {date: [lowest price or None, source]},
+    source is 'search', 'overview' or error message
+    """
+    days = collections.OrderedDict((date, None) for date in dates)
+    info = {'route': '%s - %s' % (dep_iata, dest_iata), 'currency': '', 'tax': 0.0, 'days': days}
+
+    def search_day(outbound_date):
+        return_date = 'oneway'
+        if stay is not None:
+            return_date = format_date(format_date(outbound_date, 'to_date') + datetime.timedelta(days=stay), 'to_str')
+        overview = {}
+        try:
+            search_data = get_search_data(dep_iata, dest_iata, outbound_date, return_date,
+                                          templates=required_templates('dateoverview')).json()
             if return_date == 'oneway':
-                print_oneway_result(flights, fares, currency, tax, get_string_route(search_html, return_date))
+                overview = parse_date_overview(search_data)
+            result = parse_search_data(search_data, dep_iata, dest_iata, outbound_date, return_date)
+        except search_errors() as err:
+            return None, error_message(err)[0], overview
+        return result, 'search', overview
+
+    def store(date, found):
+        result, source, overview = found
+        if result is not None:
+            info.update(route=result['route'], currency=result['currency'], tax=result['tax'])
+            days[date] = [lowest_price(result, stay is not None), source]
+        elif days[date] is None:
+            days[date] = [None, source]
+        for overview_date, price in overview.items():
+            if overview_date in days and days[overview_date] is None:
+                days[overview_date] = [price, 'overview']
+
+    step = CALENDAR['overview_days'] if stay is None else 1
+    first_wave = dates[step // 2::step] if step > 1 else dates
+    for date, found in thread_map(search_day, first_wave, workers):
+        store(date, found)
+    rest = [date for date in dates if days[date] is None]
+    for date, found in thread_map(search_day, rest, workers):
+        store(date, found)
+    return info
+
+
+def lowest_price(result, round_trip):
+    """
+    Function return the lowest price of search() result (total of the cheapest option for round trip),
+    None if nothing is bookable
+    """
+    if round_trip:
+        cheapest = cheapest_combinations(result['flights'], result['fares'], 0.0, result['mix_fare'], 1)
+        return cheapest[0][6] if cheapest else None
+    prices = [price for flight in result['flights'][0] for price in flight.prices if price != 0]
+    return min(prices) if prices else None
+
+
+def print_calendar(calendar):
+    """
+    Print price calendar of search_calendar, the cheapest days are marked by *
+    """
+    prices = [day[0] for day in calendar['days'].values() if day[0] is not None]
+    cheapest = min(prices) if prices else None
+    print('\n' + calendar['route'] + '\n')
+    print('{0: ^12}{1: ^12}{2: ^15}{3: ^25}'.format('Date', 'Weekday', '  Price' + calendar['currency'],
+                                                     'Price with tax' + calendar['currency']) + '\n')
+    for date, (price, source) in calendar['days'].items():
+        line = '{0: ^12}{1: ^12}'.format(date, format_date(date, 'to_date').strftime('%a'))
+        if price is None:
+            line += '  ' + source
+        else:
+            line += '{: >13,.2f}'.format(price).replace(',', ' ') + \
+                    '{: >20,.2f}'.format(price + calendar['tax']).replace(',', ' ') + \
+                    (' *' if price == cheapest else '')
+        print(line)
+
+
+def calendar_main(args, options):
+    """
+    Calendar mode: -calendar DEP DEST FIRST_DATE LAST_DATE|+-N [--stay=N] [--workers=N]
+    Print the lowest price for each day, round trip with return after N days if --stay is used.
+    IATA codes are checked online after local checks of all arguments
+    """
+    if len(args) != 4:
+        raise ParametersError('\nCalendar needs 4 parameters: DEP DEST FIRST_DATE LAST_DATE or DEP DEST DATE +-N')
+    errors = []
+    dep_iata, dest_iata = check_iata(args[0].upper(), args[1].upper(), False, errors)
+    if errors:
+        raise ParametersError('\n' + ' '.join(errors))
+    stay = options.get('stay')
+    workers = options.get('workers')
+    dates = calendar_dates(args[2], args[3])
+    dep_iata, dest_iata = check_iata(dep_iata, dest_iata, True, errors)
+    if errors:
+        raise ParametersError('\n' + ' '.join(errors))
+    print_calendar(search_calendar(dep_iata, dest_iata, dates, stay, workers))
+
+
+def get_route_graph(workers=None):
+    """
+    Function return adjacency index of Fly Niki routes {departure IATA code: set of destination IATA codes}.
+    Lists of airports are taken from the airport cache (see prefetch_route_graph), missing ones are loaded
+    from flyniki.com on pool of threads and written to disk once at the end
+    """
+    departures = sorted(get_airports_from_site())
+
+    def destinations(dep_iata):
+        try:
+            return set(get_cached_airports(dep_iata, 'destinations', save=False))
+        except (requests.RequestException, ValueError, KeyError, TypeError):
+            return set()
+
+    try:
+        return dict(thread_map(destinations, departures, workers))
+    finally:
+        save_airport_cache()
+
+
+def find_paths(graph, dep_iata, dest_iata, max_stops=2):
+    """
+    Function return list of paths (tuples of IATA codes) from dep_iata to dest_iata with 1..max_stops stops.
+    Search goes only through airports from which dest_iata can be reached with the rest of stops.
+    Paths with less stops go first, number of paths is limited by CONNECTIONS['max_paths']
+    """
+    reach = [set([dest_iata])]
+    for _ in xrange(max_stops):
+        reach.append(set(airport for airport, destinations in graph.items() if destinations & reach[-1]))
+    paths = []
+    for stops in xrange(1, max_stops + 1):
+        level = [(dep_iata,)]
+        for hop in xrange(stops + 1):
+            allowed = reach[stops - hop]
+            level = [path + (airport,) for path in level for airport in sorted(graph.get(path[-1], ()) & allowed)
+                     if airport not in path and (airport != dest_iata or hop == stops)]
+        paths.extend(path for path in level if path[-1] == dest_iata)
+    return paths[:CONNECTIONS['max_paths']]
+
+
+def search_connections(dep_iata, dest_iata, outbound_date, max_stops=None, top=None, workers=None, graph=None):
+    """
+    Function to search itineraries with 1..max_stops stops from dep_iata to dest_iata on outbound_date.
+    Legs are searched with search() on pool of threads: leg N (from 0) on outbound_date and N * D next days,
+    where D is CONNECTIONS['max_layover'] rounded up to days (flights are assumed to arrive on the day of departure).
+    Legs are joined if the next flight departs at least MIN_CONNECTION_TIME and at most
+    CONNECTIONS['max_layover'] after arrival. Each flight costs its cheapest cabin class plus tax of the leg.
+    return list of top cheapest itineraries: [total price with tax, currency, [(route, Flight, fare, price), ...]]
+    """
+    max_stops = CONNECTIONS['max_stops'] if max_stops is None else max_stops
+    top = top or CONNECTIONS['top']
+    graph = get_route_graph(workers) if graph is None else graph
+    paths = find_paths(graph, dep_iata, dest_iata, max_stops)
+    if not paths:
+        raise SearchError('\nNo connections with up to %d stops from %s to %s' % (max_stops, dep_iata, dest_iata))
+    first_date = format_date(outbound_date, 'to_date')
+    layover_days = int(math.ceil(CONNECTIONS['max_layover'].total_seconds() / 86400))
+    leg_dates = [[format_date(first_date + datetime.timedelta(days=day), 'to_str')
+                  for day in xrange(index * layover_days + 1)] for index in xrange(max_stops + 1)]
+    legs = set()
+    for path in paths:
+        for index in xrange(len(path) - 1):
+            for date in leg_dates[index]:
+                legs.add((path[index], path[index + 1], date))
+
+    def search_leg(leg):
+        try:
+            return leg_options(search(leg[0], leg[1], leg[2], 'oneway'))
+        except search_errors():
+            return [], ''
+
+    found = dict(thread_map(search_leg, sorted(legs), workers))
+    best = []
+    for path in paths:
+        hops = []
+        for index in xrange(len(path) - 1):
+            options = []
+            currency = ''
+            for date in leg_dates[index]:
+                leg_found = found.get((path[index], path[index + 1], date), ([], ''))
+                options.extend(leg_found[0])
+                currency = currency or leg_found[1]
+            options.sort()
+            hops.append(options)
+        if all(hops):
+            join_legs(hops, [], 0.0, currency, best, top)
+    return [[-elem[0], elem[1], elem[2]] for elem in sorted(best, reverse=True)]
+
+
+def leg_options(result):
+    """
+    Function return ([(price with tax, Flight, cabin class, route), ...], currency) for oneway search() result,
+    the cheapest bookable cabin class of each flight is used
+    """
+    options = []
+    for flight in result['flights'][0]:
+        bookable = [(price, fare) for fare, price in zip(result['fares'][0], flight.prices) if price != 0]
+        if bookable:
+            price, fare = min(bookable)
+            options.append((price + result['tax'], flight, fare, result['route']))
+    return options, result['currency']
+
+
+def join_legs(hops, itinerary, total, currency, best, top):
+    """
+    Depth-first join of legs (hops - list of options sorted by price for each leg) with the pruning by price:
+    branch is cut when its total with the cheapest options of the rest legs can not get into top cheapest.
+    best is heap of (-total, currency, itinerary) with top itineraries found so far
+    """
+    if len(itinerary) == len(hops):
+        heapq.heappush(best, (-total, currency, list(itinerary)))
+        if len(best) > top:
+            heapq.heappop(best)
+        return
+    rest = sum(hop[0][0] for hop in hops[len(itinerary) + 1:])
+    previous = itinerary[-1][1] if itinerary else None
+    for price, flight, fare, route in hops[len(itinerary)]:
+        if len(best) == top and total + price + rest >= -best[0][0]:
+            break
+        if previous is not None and not (previous.arrival + MIN_CONNECTION_TIME <= flight.departure <=
+                                         previous.arrival + CONNECTIONS['max_layover']):
+            continue
+        itinerary.append((route, flight, fare, price))
+        join_legs(hops, itinerary, total + price, currency, best, top)
+        itinerary.pop()
+
+
+def print_connections(itineraries, dep_iata, dest_iata):
+    """
+    Print itineraries of search_connections sorted by a total amount
+    """
+    print('\n%s - %s, %d itineraries with stops\n' % (dep_iata, dest_iata, len(itineraries)))
+    for total, currency, legs in itineraries:
+        for route, flight, fare, price in legs:
+            print('{0: <40.40}{1: ^20}{2: ^20}{3: ^15}'.format(route, format_date(flight.departure, 'from_datetime'),
+                                                               format_date(flight.arrival, 'from_datetime'),
+                                                               flight.duration) +
+                  '{: >12,.2f}'.format(price).replace(',', ' ') + '  {: ^18}'.format(fare))
+        print('{: >107}'.format('Total with tax (%s):' % currency.strip('()')) +
+              '{: >20,.2f}'.format(total).replace(',', ' '))
+        print('{:-^127}'.format(''))
+
+
+def connections_main(args, options):
+    """
+    Connections mode: -connections DEP DEST DATE [--stops=N] [--top=N] [--workers=N]
+    Print the cheapest itineraries with 1..N stops over the Fly Niki route graph.
+    """
+    if len(args) != 3:
+        raise ParametersError('\nConnections search needs 3 parameters: DEP DEST DATE')
+    errors = []
+    dep_iata, dest_iata = check_iata(args[0].upper(), args[1].upper(), False, errors)
+    outbound_date = check_dates(args[2], 'oneway', errors=errors)[0]
+    if dep_iata and dep_iata not in get_airports_from_site():
+        errors.append('Departure airport IATA code %s not found on flyniki.com' % dep_iata)
+    if dest_iata and dest_iata not in get_airports_from_site(searchfor='destinations'):
+        errors.append('Destinations airport IATA code %s not found on flyniki.com' % dest_iata)
+    if errors:
+        raise ParametersError('\n' + ' '.join(errors))
+    max_stops = options.get('stops')
+    top = options.get('top')
+    workers = options.get('workers')
+    itineraries = search_connections(dep_iata, dest_iata, outbound_date, max_stops, top, workers)
+    if not itineraries:
+        raise SearchError('\nNo connections found for the entered data.')
+    print_connections(itineraries, dep_iata, dest_iata)
+
+
+def watch_snapshot(result):
+    """
+    Function return prices of search() result: {(direction, departure, arrival, cabin class): price},
+    notbookable prices are skipped
+    """
+    snapshot = {}
+    for direction, flights, fares in zip(('outbound', 'return'), result['flights'], result['fares']):
+        for flight in flights:
+            for fare, price in zip(fares, flight.prices):
+                if price != 0:
+                    snapshot[(direction, flight.departure, flight.arrival, fare)] = price
+    return snapshot
+
+
+def fare_deltas(old, new):
+    """
+    Generator of changes between two watch_snapshot: (event, key, old price, new price),
+    event is 'new', 'removed', 'price_drop' or 'price_rise'
+    """
+    for key, price in sorted(new.items()):
+        if key not in old:
+            yield 'new', key, None, price
+        elif price < old[key]:
+            yield 'price_drop', key, old[key], price
+        elif price > old[key]:
+            yield 'price_rise', key, old[key], price
+    for key in sorted(set(old) - set(new)):
+        yield 'removed', key, old[key], None
+
+
+def poll_query(query, state):
+    """
+    Poll one watched query (checked parameters). Templates main and priceoverview are hashed first,
+    unchanged response is not parsed. state keeps digest, snapshot, route and currency between polls.
+    Response with "No connections" is an empty snapshot: all flights of the last one are removed.
+    return list of event dicts
+    """
+    dep_iata, dest_iata, outbound_date, return_date = query
+    search_data = get_search_data(dep_iata, dest_iata, outbound_date, return_date).json()
+    try:
+        check_for_result_errors(search_data)
+    except NoConnectionsError:
+        count('watch_no_connections')
+        state['digest'] = None
+        return snapshot_events(query, state, {})
+    templates = search_data['templates']
+    digest = hashlib.sha1((templates['main'] + templates['priceoverview']).encode('utf-8')).hexdigest()
+    if digest == state.get('digest'):
+        count('watch_unchanged_pages')
+        return []
+    result = parse_search_data(search_data, dep_iata, dest_iata, outbound_date, return_date)
+    state['route'] = result['route']
+    state['currency'] = result['currency'].strip('()')
+    state['digest'] = digest
+    return snapshot_events(query, state, watch_snapshot(result))
+
+
+def snapshot_events(query, state, snapshot):
+    """
+    Function return list of event dicts of fare_deltas between snapshot of state and new snapshot,
+    which replaces it in state
+    """
+    events = []
+    now = datetime.datetime.now().replace(microsecond=0).isoformat()
+    for event, (direction, departure, arrival, fare), old_price, price in fare_deltas(state.get('snapshot', {}),
+                                                                                      snapshot):
+        events.append({'event': event, 'time': now, 'query': query, 'route': state.get('route', ''),
+                       'direction': direction, 'departure': departure.isoformat(), 'arrival': arrival.isoformat(),
+                       'fare': fare, 'old_price': old_price, 'price': price,
+                       'currency': state.get('currency', '')})
+    state['snapshot'] = snapshot
+    return events
+
+
+def next_poll_time(interval=None, jitter=None):
+    """
+    Function return time of next poll: now + interval +- jitter part of interval
+    """
+    interval = WATCH['interval'] if interval is None else interval
+    jitter = WATCH['jitter'] if jitter is None else jitter
+    return time.time() + interval * (1 + random.uniform(-jitter, jitter))
+
+
+def watch(queries, rounds=None, workers=None, stream=None):
+    """
+    Long-running fare watch: each query (checked parameters) is polled every WATCH['interval'] seconds
+    with jitter, due queries are polled on pool of threads. Fare deltas are written to stream (stdout by default)
+    as JSON lines, errors to stderr. rounds - number of polls of each query (None - forever)
+    """
+    stream = stream or sys.stdout
+    states = [{'polls': 0} for _ in queries]
+    schedule = [(time.time() + index * 0.01, index) for index in xrange(len(queries))]
+    heapq.heapify(schedule)
+
+    def poll(index):
+        try:
+            return poll_query(queries[index], states[index])
+        except search_errors() as err:
+            return error_message(err)[0]
+
+    while schedule:
+        time.sleep(max(0, schedule[0][0] - time.time()))
+        due = []
+        while schedule and schedule[0][0] <= time.time():
+            due.append(heapq.heappop(schedule)[1])
+        for index, events in thread_map(poll, due, workers):
+            if isinstance(events, basestring):
+                sys.stderr.write('%s: %s\n' % (' '.join(queries[index]), events))
             else:
-                print_mix_result(flights, fares, currency, tax, get_string_route(search_html, return_date),
-                                 check_combinability(search_html))
-        except (ParametersError, SearchError) as err:
-            print(err)
-        except requests.ConnectionError:
-            print('\nNo response from www.flyniki.com')
-        except (ValueError, KeyError, IndexError):
-            print('\nWrong data format from www.flyniki.com')
+                for event in events:
+                    stream.write(json.dumps(event) + '\n')
+                stream.flush()
+            states[index]['polls'] += 1
+            dump_stats()
+            if rounds is None or states[index]['polls'] < rounds:
+                heapq.heappush(schedule, (next_poll_time(), index))
+
+
+def watch_main(args, options):
+    """
+    Watch mode: -watch [file|-] [--interval=SECONDS] [--jitter=PART] [--rounds=N] [--workers=N]
+    Poll queries of the watchlist (CSV or JSON Lines as in batch mode) and write fare deltas as JSON lines.
+    """
+    if 'interval' in options:
+        WATCH['interval'] = options['interval']
+    if 'jitter' in options:
+        WATCH['jitter'] = options['jitter']
+    stream = sys.stdin if (not args or args[0] == '-') else open(args[0])
+    queries = []
+    try:
+        for query in read_queries(stream):
+            if isinstance(query, dict):
+                sys.stderr.write('%s: %s\n' % (' '.join(query['query']), query['error']))
+                continue
+            try:
+                queries.append(validate_query(query))
+            except ParametersError as err:
+                sys.stderr.write('%s: %s\n' % (' '.join(query), str(err).strip()))
+    finally:
+        if stream is not sys.stdin:
+            stream.close()
+    if not queries:
+        raise ParametersError('\nNo correct queries to watch')
+    watch(queries, options.get('rounds'), options.get('workers'))
+
+
+def history_connection():
+    """
+    Function return shared connection to fare history database HISTORY['path'], creating tables on first use.
+    Use under _history_lock
+    """
+    if _history['connection'] is None:
+        connection = sqlite3.connect(HISTORY['path'], check_same_thread=False)
+        connection.executescript(HISTORY_SCHEMA)
+        _history['connection'] = connection
+    return _history['connection']
+
+
+def close_history():
+    """
+    Close connection to fare history database
+    """
+    with _history_lock:
+        if _history['connection'] is not None:
+            _history['connection'].close()
+            _history['connection'] = None
+
+
+def record_history(dep_iata, dest_iata, outbound_date, return_date, result):
+    """
+    Append parsed result (see parse_search_data) to fare history: one scrape for each table of flights
+    (route DEP-DEST, return DEST-DEP) and one row of prices for each bookable fare of flight
+    """
+    routes = ('%s-%s' % (dep_iata.upper(), dest_iata.upper()), '%s-%s' % (dest_iata.upper(), dep_iata.upper()))
+    query_dates = [format_date(date, 'to_flyniki') for date in (outbound_date, return_date) if date != 'oneway']
+    scraped_at = time.time()
+    rows = 0
+    with _history_lock:
+        connection = history_connection()
+        with connection:
+            for route, query_date, table, fares in zip(routes, query_dates, result['flights'], result['fares']):
+                scrape_id = connection.execute(
+                    'INSERT INTO scrapes (route, query_date, scraped_at, currency, tax) VALUES (?, ?, ?, ?, ?)',
+                    (route, query_date, scraped_at, result['currency'], result['tax'])).lastrowid
+                rows += connection.executemany(
+                    'INSERT INTO prices VALUES (?, ?, ?, ?, ?, ?, ?)',
+                    ((scrape_id, route, flight.departure.date().isoformat(), flight.departure.isoformat(' '),
+                      flight.arrival.isoformat(' '), fare, price)
+                     for flight in table for fare, price in zip(fares, flight.prices) if price)).rowcount
+    count('history_rows', rows)
+
+
+def min_price_per_day(route, last=None, fare=None):
+    """
+    Function return list of (travel date, fare, min price, number of scrapes) of route (DEP-DEST)
+    over the last scrapes of the route (HISTORY['last'] by default, 0 - all), for one fare or for each fare
+    """
+    last = HISTORY['last'] if last is None else last
+    query = ('SELECT travel_date, fare, MIN(price), COUNT(DISTINCT scrape_id) FROM prices '
+             'WHERE route = ? AND scrape_id >= ?%s GROUP BY travel_date, fare ORDER BY travel_date, MIN(price)')
+    with _history_lock:
+        connection = history_connection()
+        first = connection.execute('SELECT MIN(id) FROM (SELECT id FROM scrapes WHERE route = ? '
+                                   'ORDER BY id DESC LIMIT ?)', (route, last or -1)).fetchone()[0]
+        if fare is None:
+            return connection.execute(query % '', (route, first or 0)).fetchall()
+        return connection.execute(query % ' AND fare = ?', (route, first or 0, fare)).fetchall()
+
+
+def price_trend(route, travel_date, fare=None):
+    """
+    Function return list of (scrape time, min, average and max price, number of flights) of route (DEP-DEST)
+    for travel date (datetime.date) over all scrapes, for one fare or for all fares
+    """
+    query = ('SELECT scrapes.scraped_at, MIN(price), AVG(price), MAX(price), COUNT(DISTINCT departure) '
+             'FROM prices JOIN scrapes ON scrapes.id = prices.scrape_id '
+             'WHERE prices.route = ? AND travel_date = ?%s GROUP BY scrape_id ORDER BY scrape_id')
+    parameters = (route, travel_date.isoformat())
+    with _history_lock:
+        connection = history_connection()
+        if fare is None:
+            return connection.execute(query % '', parameters).fetchall()
+        return connection.execute(query % ' AND fare = ?', parameters + (fare,)).fetchall()
+
+
+def history_main(args, options):
+    """
+    History mode: -history DEP DEST [DD.MM.YY] [--history=PATH] [--last=N] [--fare=NAME]
+    Print min price per day of route over the last N scrapes, or price trend of the date over all scrapes
+    """
+    if len(args) not in (2, 3):
+        raise ParametersError('\nUse -history DEP DEST [DD.MM.YY]')
+    route = '%s-%s' % (args[0].upper(), args[1].upper())
+    if not os.path.exists(HISTORY['path']):
+        raise SearchError('\nNo fare history %s, search with --history to save it' % HISTORY['path'])
+    fare = options.get('fare')
+    if len(args) == 3:
+        try:
+            travel_date = format_date(args[2], 'to_date')
+        except ValueError:
+            raise ParametersError('\nWrong date %s, use DD.MM.YY' % args[2])
+        rows = price_trend(route, travel_date, fare)
+        for scraped_at, low, average, high, flights in rows:
+            print('{0}  {1: >10.2f}{2: >10.2f}{3: >10.2f}{4: >5} flights'.format(
+                time.strftime('%d.%m.%y %H:%M', time.localtime(scraped_at)), low, average, high, flights))
+    else:
+        rows = min_price_per_day(route, options.get('last'), fare)
+        for travel_date, fare, price, scrapes in rows:
+            print('{0}  {1: <20}{2: >10.2f}{3: >5} scrapes'.format(
+                format_date(datetime.datetime.strptime(travel_date, '%Y-%m-%d').date(), 'to_str'), fare, price,
+                scrapes))
+    if not rows:
+        raise SearchError('\nNo history of %s in %s' % (route, HISTORY['path']))
+
+
+def check_main(args, options):
+    """
+    Check mode: -check [file|-] [--online]
+    Validate queries (CSV or JSON Lines as in batch mode) without searching. IATA codes are checked against
+    airport snapshot (saved by -prefetch or --airports=PATH) without flyniki.com, unless --online is given.
+    Correct queries are written to stdout as CSV (ready for -batch), errors to stderr
+    """
+    if 'online' not in options:
+        AIRPORT_CACHE['offline'] = True
+    stream = sys.stdin if (not args or args[0] == '-') else open(args[0])
+    writer = csv.writer(sys.stdout, lineterminator='\n')
+    errors = 0
+    try:
+        for query in read_queries(stream):
+            if isinstance(query, dict):
+                errors += 1
+                sys.stderr.write('%s: %s\n' % (' '.join(query['query']), query['error']))
+                continue
+            try:
+                writer.writerow(validate_query(query))
+            except ParametersError as err:
+                errors += 1
+                sys.stderr.write('%s: %s\n' % (' '.join(query), str(err).strip()))
+    finally:
+        if stream is not sys.stdin:
+            stream.close()
+    if errors:
+        raise ParametersError('\n%d incorrect queries' % errors)
+
+
+def serve_search(query):
+    """
+    Run search for JSON query of search server: object with dep_iata, dest_iata, outbound_date,
+    return_date (optional), limit (optional, number of records, SERVER['top'] by default).
+    return (HTTP status, body): result_to_dict of search() with records of iter_records, or error
+    """
+    if not isinstance(query, dict):
+        return 400, {'error': 'Request body must be JSON object'}
+    parameters = [query.get(key) or '' for key in ('dep_iata', 'dest_iata', 'outbound_date', 'return_date')]
+    limit = query.get('limit', SERVER['top'])
+    if isinstance(limit, bool) or not isinstance(limit, (int, long)) or limit < 0:
+        return 400, {'error': 'limit must be non-negative integer'}
+    try:
+        dep_iata, dest_iata, outbound_date, return_date = validate_query(parameters)
+        result = search(dep_iata, dest_iata, outbound_date, return_date)
+    except search_errors() as err:
+        message, status = error_message(err)
+        return status, {'error': message}
+    body = result_to_dict(result)
+    body['records'] = [dict(zip(RECORD_FIELDS, record_values(record)))
+                       for record in iter_records(result, return_date, limit)]
+    return 200, body
+
+
+def serve(host=None, port=None, max_requests=None):
+    """
+    Run search server: JSON API over HTTP, sessions and caches stay warm between requests.
+    Searches over max_requests at a time get 503 with Retry-After
+    """
+    server = SearchServer((host or SERVER['host'], port or SERVER['port']), max_requests)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+
+def serve_main(args, options):
+    """
+    Server mode: -serve [--host=HOST] [--port=PORT] [--max-requests=N]
+    POST /search {"dep_iata": "DME", "dest_iata": "LON", "outbound_date": "17.04.17", "return_date": "06.05.17"},
+    GET /stats, GET /health
+    """
+    STATS['enabled'] = True
+    port = options.get('port', SERVER['port'])
+    sys.stderr.write('Serving on http://%s:%d/search\n' % (options.get('host', SERVER['host']), port))
+    serve(options.get('host'), port, options.get('max-requests'))
+
+
+def configure(options):
+    """
+    Apply options common for all modes: --record=DIR or --replay=DIR (see site_request),
+    --cache-ttl=SECONDS for results of search (0 - no cache), --format=text|jsonl|csv,
+    --profile (print stats of stages), --stats-file=PATH (dump stats, .json or Prometheus text),
+    --lean (ask only templates main, priceoverview and dateoverview), --history[=PATH] (append results to fare history),
+    --airports=PATH (airport snapshot file), --offline (check IATA codes only against airport snapshot),
+    --rate=endpoint:rate[/burst],... (see parse_rate_budgets), --retries=N, --per-host=N (max simultaneous requests)
+    """
+    if options.get('format', 'text') not in OUTPUT_FORMATS:
+        raise ParametersError('\nUnknown output format %s, use one of: %s' % (options['format'],
+                                                                              ', '.join(OUTPUT_FORMATS)))
+    if 'cache-ttl' in options:
+        RESULT_CACHE['ttl'] = options['cache-ttl']
+    if 'lean' in options:
+        SEARCH['templates'] = LEAN_TEMPLATES
+    if 'profile' in options or 'stats-file' in options:
+        STATS['enabled'] = True
+    if options.get('stats-file') not in (None, True):
+        STATS['dump_path'] = options['stats-file']
+    if options.get('airports') not in (None, True):
+        AIRPORT_CACHE['path'] = options['airports']
+    if 'offline' in options:
+        AIRPORT_CACHE['offline'] = True
+    if options.get('rate') not in (None, True):
+        RATE_LIMIT['budgets'].update(parse_rate_budgets(options['rate']))
+    if 'retries' in options:
+        RATE_LIMIT['retries'] = options['retries']
+    if 'per-host' in options:
+        BATCH['per_host'] = options['per-host']
+    if 'history' in options:
+        HISTORY['enabled'] = True
+        if options['history'] is not True:
+            HISTORY['path'] = options['history']
+    for mode in ('record', 'replay'):
+        if mode in options:
+            TRANSPORT['mode'] = mode
+            if options[mode] is not True:
+                TRANSPORT['path'] = options[mode]
+
+
+def run_mode(mode, args, options):
+    """
+    Run non-interactive mode function mode(args, options), exit with message on errors.
+    Stats are printed to stderr (--profile) and dumped (--stats-file) at the end
+    """
+    try:
+        mode(args, options)
+    except search_errors() as err:
+        sys.exit('\n' + error_message(err)[0])
+    except KeyboardInterrupt:
+        sys.exit('\nEnd of session')
+    finally:
+        if 'profile' in options:
+            sys.stderr.write('\n' + format_stats() + '\n')
+        dump_stats()
+
+
+def flyniki_search(search_parameters):
+    """
+    Main function
+    """
+    search_parameters = search_parameters[1:] if (len(search_parameters) > 1) else []
+    try:
+        search_parameters, options = parse_options(search_parameters)
+        configure(options)
+    except ParametersError as err:
+        sys.exit(err)
+    modes = {'batch': batch_main,
+             'calendar': calendar_main,
+             'watch': watch_main,
+             'connections': connections_main,
+             'serve': serve_main,
+             'history': history_main,
+             'check': check_main}
+    if search_parameters and search_parameters[0].lower().lstrip('-') in modes:
+        return run_mode(modes[search_parameters[0].lower().lstrip('-')], search_parameters[1:], options)
+    limit = options.get('top')
+    output_format = options.get('format', 'text')
+    while True:
+        try:
+            dep_iata, dest_iata, outbound_date, return_date = check_search_parameters(search_parameters)
+            write_result(search(dep_iata, dest_iata, outbound_date, return_date), return_date, output_format, limit)
+            dump_stats()
+            if 'profile' in options:
+                print('\n' + format_stats())
+                reset_stats()
+        except search_errors() as err:
+            print('\n' + error_message(err)[0])
         if raw_input('\nDo you want re-enter your search query? y/n ') not in ['Y', 'y']:
             sys.exit('\nEnd of session')
         search_parameters = raw_input('\nEnter the search parameters through the space, -h for help, or '
@@ -0,0 +1,285 @@
+"""
+Behaviour tests for fly niki scraper, flyniki.com is not used:
+python -m unittest test_main
+"""
+import random
+import datetime
+import threading
+import itertools
+import unittest
+import main
+
+
+FARES = ('Economy Saver', 'Economy Classic', 'Business')
+DAY = datetime.datetime(2017, 4, 17)
+REAL_TIME = main.time
+
+
+def make_flight(departure_minutes, duration_minutes, prices):
+    """
+    Flight departing departure_minutes after DAY with prices for FARES
+    """
+    departure = DAY + datetime.timedelta(minutes=departure_minutes)
+    return main.Flight(departure, departure + datetime.timedelta(minutes=duration_minutes), '', prices)
+
+
+def random_flights(seed, rows=8):
+    """
+    Outbound and return tables of random flights, about a quarter of prices are notbookable (0)
+    """
+    rand = random.Random(seed)
+    tables = []
+    for first_minute in (0, 6 * 60):
+        tables.append([make_flight(first_minute + rand.randrange(0, 12 * 60, 15), rand.randrange(60, 240, 5),
+                                   [rand.choice((0, rand.randrange(50, 500))) for _ in FARES])
+                       for _ in xrange(rows)])
+    return tables
+
+
+def brute_force(flights, fares, tax, mix_fare):
+    """
+    Reference of combine_flights: every pair of outbound and return flights is checked
+    """
+    def legs(table, table_fares):
+        for flight in table:
+            bookable = [(price, fare) for fare, price in zip(table_fares, flight.prices) if price]
+            if mix_fare:
+                bookable = [min(bookable)] if bookable else []
+            for price, fare in bookable:
+                yield flight, price, fare
+
+    options = []
+    for (out_flight, out_price, out_fare), (ret_flight, ret_price, ret_fare) in itertools.product(
+            legs(flights[0], fares[0]), legs(flights[1], fares[1])):
+        if ret_flight.departure < out_flight.arrival + main.MIN_CONNECTION_TIME:
+            continue
+        if not mix_fare and out_fare != ret_fare:
+            continue
+        options.append([out_flight, out_price, out_fare, ret_flight, ret_price, ret_fare,
+                        out_price + ret_price, out_price + ret_price + tax])
+    return options
+
+
+def option_key(option):
+    return (option[7], id(option[0]), option[2], id(option[3]), option[5])
+
+
+class CombineFlightsTest(unittest.TestCase):
+
+    def check_against_brute_force(self, flights, fares, mix_fare):
+        options = list(main.combine_flights(flights, fares, 10.0, mix_fare))
+        expected = brute_force(flights, fares, 10.0, mix_fare)
+        self.assertEqual(sorted(map(option_key, options)), sorted(map(option_key, expected)))
+        self.assertEqual([option[7] for option in options], sorted(option[7] for option in options))
+        self.assertEqual(main.count_combinations(flights, fares, mix_fare), len(expected))
+
+    def test_same_as_brute_force(self):
+        for seed in xrange(20):
+            for mix_fare in (True, False):
+                self.check_against_brute_force(random_flights(seed), [FARES, FARES], mix_fare)
+
+    def test_connection_time_boundary(self):
+        outbound = make_flight(0, 60, [100, 0, 0])
+        on_time = make_flight(120, 60, [100, 0, 0])
+        too_early = make_flight(119, 60, [50, 0, 0])
+        options = list(main.combine_flights([[outbound], [on_time, too_early]], [FARES, FARES], 0, True))
+        self.assertEqual([(option[0], option[3]) for option in options], [(outbound, on_time)])
+
+    def test_notbookable_prices_are_skipped(self):
+        outbound = make_flight(0, 60, [0, 200, 0])
+        notbookable = make_flight(300, 60, [0, 0, 0])
+        ret = make_flight(300, 60, [0, 0, 300])
+        options = list(main.combine_flights([[outbound], [notbookable, ret]], [FARES, FARES], 0, True))
+        self.assertEqual([option[1:3] + option[4:7] for option in options],
+                         [[200, 'Economy Classic', 300, 'Business', 500]])
+        self.assertEqual(list(main.combine_flights([[outbound], [notbookable, ret]], [FARES, FARES], 0, False)), [])
+
+    def test_mix_fare_uses_cheapest_fare_of_flight(self):
+        outbound = make_flight(0, 60, [100, 150, 400])
+        ret = make_flight(300, 60, [120, 110, 0])
+        options = list(main.combine_flights([[outbound], [ret]], [FARES, FARES], 0, True))
+        self.assertEqual([option[2] + ' / ' + option[5] for option in options], ['Economy Saver / Economy Classic'])
+
+    def test_fares_are_not_mixed_without_mix_fare(self):
+        outbound = make_flight(0, 60, [100, 150, 400])
+        ret = make_flight(300, 60, [120, 110, 500])
+        out_fares = FARES
+        ret_fares = ('Economy Saver', 'Economy Flex', 'Business')
+        options = list(main.combine_flights([[outbound], [ret]], [out_fares, ret_fares], 0, False))
+        self.assertEqual([(option[2], option[5], option[6]) for option in options],
+                         [('Economy Saver', 'Economy Saver', 220), ('Business', 'Business', 900)])
+        self.assertEqual(main.count_combinations([[outbound], [ret]], [out_fares, ret_fares], False), 2)
+
+
+def simple_paths(graph, dep_iata, dest_iata, max_stops):
+    """
+    Reference of find_paths: every path without repeated airports with 1..max_stops stops
+    """
+    paths = []
+    stack = [(dep_iata,)]
+    while stack:
+        path = stack.pop()
+        if path[-1] == dest_iata:
+            if len(path) > 2:
+                paths.append(path)
+            continue
+        if len(path) < max_stops + 2:
+            stack.extend(path + (airport,) for airport in graph.get(path[-1], ()) if airport not in path)
+    return paths
+
+
+class ConnectionsTest(unittest.TestCase):
+
+    def test_find_paths_same_as_exhaustive_search(self):
+        airports = ['A%d' % index for index in xrange(8)]
+        for seed in xrange(20):
+            rand = random.Random(seed)
+            graph = dict((airport, set(rand.sample([other for other in airports if other != airport], 3)))
+                         for airport in airports)
+            for max_stops in (1, 2, 3):
+                paths = main.find_paths(graph, 'A0', 'A1', max_stops)
+                self.assertEqual(sorted(paths), sorted(simple_paths(graph, 'A0', 'A1', max_stops)))
+                self.assertEqual([len(path) for path in paths], sorted(len(path) for path in paths))
+
+    def test_join_legs_finds_cheapest_itineraries(self):
+        for seed in xrange(20):
+            rand = random.Random(seed)
+            hops = []
+            for leg in xrange(3):
+                hops.append(sorted((float(rand.randrange(50, 500)),
+                                    make_flight(leg * 600 + rand.randrange(0, 900, 30), 90, [1, 0, 0]), 'Saver',
+                                    'L%d' % leg) for _ in xrange(6)))
+            best = []
+            main.join_legs(hops, [], 0.0, 'RUB', best, 5)
+            expected = []
+            for itinerary in itertools.product(*hops):
+                if all(itinerary[index][1].arrival + main.MIN_CONNECTION_TIME <= itinerary[index + 1][1].departure <=
+                       itinerary[index][1].arrival + main.CONNECTIONS['max_layover'] for index in xrange(2)):
+                    expected.append(sum(option[0] for option in itinerary))
+            self.assertEqual(sorted(-elem[0] for elem in best), sorted(expected)[:5])
+
+    def test_later_legs_are_searched_on_following_days(self):
+        searched = []
+
+        def fake_search(dep_iata, dest_iata, outbound_date, return_date):
+            searched.append((dep_iata, outbound_date))
+            raise main.SearchError('\nNo connections')
+
+        search, main.search = main.search, fake_search
+        try:
+            main.search_connections('DME', 'LON', '17.04.17', 2, graph={'DME': {'VIE'}, 'VIE': {'BER'},
+                                                                          'BER': {'LON'}})
+        finally:
+            main.search = search
+        self.assertEqual(sorted(searched), [('BER', '17.04.17'), ('BER', '18.04.17'), ('BER', '19.04.17'),
+                                            ('DME', '17.04.17'), ('VIE', '17.04.17'), ('VIE', '18.04.17')])
+
+
+class FareDeltasTest(unittest.TestCase):
+
+    def test_snapshot_skips_notbookable_prices(self):
+        outbound = make_flight(0, 60, [100, 0, 300])
+        snapshot = main.watch_snapshot({'flights': [[outbound], []], 'fares': [FARES, FARES]})
+        self.assertEqual(snapshot, {('outbound', outbound.departure, outbound.arrival, 'Economy Saver'): 100,
+                                    ('outbound', outbound.departure, outbound.arrival, 'Business'): 300})
+
+    def test_all_kinds_of_changes(self):
+        old = {'drop': 100, 'rise': 100, 'same': 100, 'gone': 100}
+        new = {'drop': 90, 'rise': 110, 'same': 100, 'added': 50}
+        self.assertEqual(list(main.fare_deltas(old, new)),
+                         [('new', 'added', None, 50), ('price_drop', 'drop', 100, 90),
+                          ('price_rise', 'rise', 100, 110), ('removed', 'gone', 100, None)])
+
+    def test_no_changes(self):
+        self.assertEqual(list(main.fare_deltas({'same': 100}, {'same': 100})), [])
+        self.assertEqual(list(main.fare_deltas({}, {})), [])
+
+    def test_empty_snapshot_removes_everything(self):
+        self.assertEqual(list(main.fare_deltas({'b': 2, 'a': 1}, {})),
+                         [('removed', 'a', 1, None), ('removed', 'b', 2, None)])
+
+
+class FakeClock(object):
+    """
+    Replacement of time module in main: sleep only moves the clock
+    """
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+class TokenBucketTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        main.time = self.clock
+
+    def tearDown(self):
+        main.time = REAL_TIME
+
+    def test_burst_then_rate(self):
+        bucket = main.TokenBucket(4.0, 3)
+        self.assertEqual([bucket.acquire() for _ in xrange(3)], [0, 0, 0])
+        self.assertAlmostEqual(bucket.acquire(), 0.25)
+        self.assertAlmostEqual(bucket.acquire(), 0.25)
+        self.assertAlmostEqual(self.clock.now, 1000.5)
+
+    def test_tokens_refill_up_to_burst(self):
+        bucket = main.TokenBucket(4.0, 3)
+        for _ in xrange(3):
+            bucket.acquire()
+        self.clock.now += 60
+        self.assertEqual([bucket.acquire() for _ in xrange(3)], [0, 0, 0])
+        self.assertAlmostEqual(bucket.acquire(), 0.25)
+
+
+class AdaptiveLimiterTest(unittest.TestCase):
+
+    def test_failure_halves_limit_down_to_one(self):
+        limiter = main.AdaptiveLimiter(8)
+        for limit in (4.0, 2.0, 1.0, 1.0):
+            limiter.acquire()
+            limiter.release(False)
+            self.assertEqual(limiter.limit, limit)
+
+    def test_success_grows_limit_up_to_max(self):
+        limiter = main.AdaptiveLimiter(3)
+        limiter.limit = 1.0
+        limiter.acquire()
+        limiter.release(True)
+        self.assertEqual(limiter.limit, 2.0)
+        limiter.acquire()
+        limiter.release(True)
+        self.assertEqual(limiter.limit, 2.5)
+        for _ in xrange(10):
+            limiter.acquire()
+            limiter.release(True)
+        self.assertEqual(limiter.limit, 3)
+
+    def test_acquire_waits_at_limit(self):
+        limiter = main.AdaptiveLimiter(2)
+        limiter.acquire()
+        limiter.acquire()
+        acquired = threading.Event()
+
+        def waiting():
+            limiter.acquire()
+            acquired.set()
+
+        thread = threading.Thread(target=waiting)
+        thread.daemon = True
+        thread.start()
+        self.assertFalse(acquired.wait(0.1))
+        limiter.release(True)
+        self.assertTrue(acquired.wait(5))
+        thread.join(5)
+        self.assertEqual(limiter.in_flight, 2)
+
+
+if __name__ == "__main__":
+    unittest.main()